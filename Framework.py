@@ -2,9 +2,11 @@ import json
 import logging
 import os
 import queue
-import threading, LLMAPI, Formats
+import threading, asyncio, LLMAPI, Formats
+from concurrent.futures import ThreadPoolExecutor
+from difflib import SequenceMatcher
 from lib_helper import func_name, load_json_with_comments
-import STT.STTServer, Tools.Database, Tools.VectorDatabase, Tools.Crawler
+import STT.STTServer, Tools.Database, Tools.VectorDatabase, Tools.Crawler, Tools.MemoryWriter, Tools.TranslationMemory
 
 class Framework:
     def __init__(self, description_override: str|None=None):
@@ -26,7 +28,7 @@ class Framework:
                     result = self.llms.req([
                         {"role": "system", "content": LLMAPI.INITIAL_PROMPT_GENERATION},
                         {"role": "user", "content": self.description}
-                    ], self.settings["llms"]["SmallModel"])["content"]
+                    ], self.settings["llms"]["SmallModel"], stage="initial_prompt")["content"]
                     result = result.strip() if result.strip() != "UNKNOWN" else ""
                 except Exception as e:
                     logging.warning(f"{func_name()}: STT初始Prompt生成失败：{e}")
@@ -41,7 +43,7 @@ class Framework:
                         result = self.llms.req([
                             {"role": "system", "content": LLMAPI.INITIAL_PROMPT_GENERATION},
                             {"role": "user", "content": self.description}
-                        ], self.settings["llms"]["SmallModel"])["content"]
+                        ], self.settings["llms"]["SmallModel"], stage="initial_prompt")["content"]
                         result = result.strip() if result.strip() != "UNKNOWN" else ""
                     except Exception as e:
                         logging.warning(f"{func_name()}: STT初始Prompt生成失败：{e}")
@@ -52,11 +54,38 @@ class Framework:
                 result = ""
         self.stt = STT.STTServer.STTServer(result)
 
-        self.db = Tools.Database.DB()
-        embedder = Tools.VectorDatabase.Embedder(self.settings["embedding_model_name"])
-        self.vdb = Tools.VectorDatabase.VDB(embedder)
+        # 持久TM时全文库和向量记忆都放在translation_memory.dir下，按namespace分区，跨会话保留
+        self.tm_persistent = self.settings.get("translation_memory", {}).get("persistent", False)
+        db_path, vector_dir, namespace = Tools.TranslationMemory.tm_paths(self.settings)
+        fulltext = self.settings.get("fulltext", {})
+        self.db = Tools.Database.DB(
+            db_path if self.tm_persistent else "Tools/Database.db",
+            clean=not self.tm_persistent,
+            tokenizer=fulltext.get("tokenizer", "trigram"),
+            weights=(fulltext.get("original_weight", 2.0), fulltext.get("translated_weight", 1.0)),
+            namespace=namespace if self.tm_persistent else ""
+        )
+        embedder = Tools.VectorDatabase.Embedder(
+            self.settings["embedding_model_name"],
+            self.settings.get("embedding_batch_size", 64),
+            self.settings.get("embedding_cache_size", 20000)
+        )
+        self.vdb = Tools.VectorDatabase.VDB(
+            embedder,
+            index_settings=self.settings.get("vector_index", {}),
+            persist_dir=vector_dir if self.tm_persistent else None
+        )
+        memory_writer = self.settings.get("memory_writer", {})
+        self.memory = Tools.MemoryWriter.MemoryWriter(
+            self.vdb, 
+            self.db, 
+            memory_writer.get("max_pending", 64), 
+            memory_writer.get("batch_size", 512)
+        ) if memory_writer.get("enable", True) else None
         self.crawler = Tools.Crawler.Crawler(self.settings["Crawler"]["website"])
         self.processing_queue = queue.Queue()
+        self.max_workers = max(1, int(self.settings.get("max_workers", 4)))
+        self.use_async = self.settings.get("use_async", False)
 
     def run(self): # 待测试
         """总启动"""
@@ -72,22 +101,26 @@ class Framework:
             PostTaskList = []
 
             for _ in range(10):
-                path = os.path.normpath(self.processing_queue.get())
+                item = self.processing_queue.get()
+                chunks = None
+                if isinstance(item, STT.STTServer.SegmentStream):
+                    # 流式转录：边收句段边翻译，转录结束后再读完整的json
+                    chunks = self.translate_stream(item)
+                    if item.result_path is None: continue
+                    item = item.result_path
+                path = os.path.normpath(item)
                 if path == STT.STTServer.DONE: 
                     logging.info(f"{func_name()}: 翻译完毕")
                     break
+                self.llms.current_file = os.path.basename(path)
 
                 with open(path, "r", encoding="utf-8") as f: OriginalJsonData = json.load(f)
                 if self.settings.get("delay_segment_ends", 0.0) > 0.0: OriginalJsonData = Formats.delay_segment_ends(OriginalJsonData, self.settings["delay_segment_ends"])
-                chunks = Formats.normal_chunks(OriginalJsonData, self.settings["chunk_size"])
-
-                processed_chunks = []
-                prev = None
-                for chunk in chunks:
-                    processed_chunk = self.Task(chunk, prev)
-                    processed_chunks.append(processed_chunk)
-                    # 这里是主要处理，记得Task要传入prev参数，prev是mem格式
-                chunks = processed_chunks
+                if chunks is None:
+                    chunks = Formats.normal_chunks(OriginalJsonData, self.settings["chunk_size"])
+
+                    # 这里是主要处理。各块之间互不依赖（prev恒为None），所以并发执行，结果按原顺序返回
+                    chunks = self.map_chunks(self.Task, chunks, self.ATask)
                 logging.debug(f"{func_name()}: 处理后chunks: {chunks}")
 
                 TranslatedJsonData = Formats.chunks2json(chunks, OriginalJsonData)
@@ -97,10 +130,12 @@ class Framework:
                 # endbug
 
             # 这个时候，数据库中便存储好了全文的记忆，而PostTaskList中存储了翻译后的json数据及其原本的文件名
+            self.flush_memory()
 
             enable_refine = self.settings["enable_refine"]
             for episode in PostTaskList:
                 filename = episode["filename"]
+                self.llms.current_file = filename
                 if filename.endswith(".json"): filename = filename[:-5]
                 TranslatedJsonData = episode["jsondata"]
                 if not enable_refine: 
@@ -110,7 +145,7 @@ class Framework:
                 # 这里才是润色的主流程
                 chunks = Formats.shifted_chunks(TranslatedJsonData, self.settings["chunk_size"]) 
 
-                chunks = [self.PostTask(chunk) for chunk in chunks]
+                chunks = self.map_chunks(self.PostTask, chunks, self.APostTask)
 
                 RefinedJsonData = Formats.chunks2json(chunks, TranslatedJsonData)
                 Formats.json2subtitle(RefinedJsonData, self.output_dir, filename, self.settings["replacing"])
@@ -119,21 +154,25 @@ class Framework:
         else:
             enable_refine = self.settings["enable_refine"]
             for _ in range(10):
-                path = os.path.normpath(self.processing_queue.get())
+                item = self.processing_queue.get()
+                chunks = None
+                if isinstance(item, STT.STTServer.SegmentStream):
+                    # 流式转录：边收句段边翻译，转录结束后再读完整的json
+                    chunks = self.translate_stream(item)
+                    if item.result_path is None: continue
+                    item = item.result_path
+                path = os.path.normpath(item)
                 if path == STT.STTServer.DONE: 
                     logging.info(f"{func_name()}: 处理完毕")
                     break
+                self.llms.current_file = os.path.basename(path)
 
                 with open(path, "r", encoding="utf-8") as f: OriginalJsonData = json.load(f)
-                chunks = Formats.normal_chunks(OriginalJsonData, self.settings["chunk_size"])
-
-                processed_chunks = []
-                prev = None
-                for chunk in chunks:
-                    processed_chunk = self.Task(chunk, prev)
-                    processed_chunks.append(processed_chunk)
-                    # 这里是主要处理，记得Task要传入prev参数，prev是mem格式
-                chunks = processed_chunks
+                if chunks is None:
+                    chunks = Formats.normal_chunks(OriginalJsonData, self.settings["chunk_size"])
+
+                    # 这里是主要处理。各块之间互不依赖（prev恒为None），所以并发执行，结果按原顺序返回
+                    chunks = self.map_chunks(self.Task, chunks, self.ATask)
                 logging.debug(f"{func_name()}: 处理后chunks: {chunks}")
 
                 TranslatedJsonData = Formats.chunks2json(chunks, OriginalJsonData)
@@ -150,20 +189,304 @@ class Framework:
                 # 这里才是润色的主流程
                 chunks = Formats.shifted_chunks(TranslatedJsonData, self.settings["chunk_size"]) 
 
-                chunks = [self.PostTask(chunk) for chunk in chunks]
+                self.flush_memory()
+                chunks = self.map_chunks(self.PostTask, chunks, self.APostTask)
 
                 RefinedJsonData = Formats.chunks2json(chunks, TranslatedJsonData)
                 Formats.json2subtitle(RefinedJsonData, self.output_dir, filename, self.settings["replacing"])
 
-                self.db.clear()
-                self.vdb.clear()
+                if not self.tm_persistent: # 持久记忆要留给以后的会话
+                    self.db.clear()
+                    self.vdb.clear()
                 logging.info(f"{func_name()}: {filename}带有润色的处理完毕")
         
+        if self.llms.cache is not None: logging.info(f"{func_name()}: LLM响应缓存统计：{self.llms.cache_stats()}")
+        logging.info(f"{func_name()}: 各文件token用量：{self.llms.usage_summary(by='file')}")
+        logging.info(f"{func_name()}: 各阶段token用量：{self.llms.usage_summary()}")
         logging.info(f"{func_name()}: 程序运行完毕")
         self.quit()
 
-    def Task(self, chunk, prev: None|list[dict]=None) -> list[dict]: 
+    def map_chunks(self, func, chunks: list[dict], afunc=None) -> list[dict]:
+        """用最多max_workers个线程并发地对每个块调用func（Task或PostTask），输出顺序与输入一致
+        \n如果启用了use_async并提供了afunc（ATask或APostTask），则改为在一个事件循环里并发执行
+        \n单个块出错时保留原文，不影响其他块"""
+        if self.use_async and afunc is not None: return asyncio.run(self.amap_chunks(afunc, chunks))
+
+        if self.max_workers == 1 or len(chunks) <= 1: return [self.safe_call(func, chunk) for chunk in chunks]
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(chunks))) as executor:
+            return list(executor.map(lambda chunk: self.safe_call(func, chunk), chunks))
+
+    @staticmethod
+    def safe_call(func, chunk: dict) -> dict:
+        try: return func(chunk)
+        except Exception as e:
+            logging.error(f"{func_name()}: 处理块失败，保留原文：{e}")
+            return chunk.copy()
+
+    def translate_stream(self, stream: STT.STTServer.SegmentStream) -> list[dict]:
+        """流式转录的翻译：每凑够chunk_size个句段就提交一个Task，不必等整个文件转录完
+        \n切块方式与Formats.normal_chunks完全一致，返回按顺序排列的翻译后chunks。启用use_async时改走atranslate_stream"""
+        self.llms.current_file = stream.name+".json"
+        if self.use_async: return asyncio.run(self.atranslate_stream(stream))
+        chunk_size = self.settings["chunk_size"]
+        futures = []
+        chunk = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for segments in stream:
+                for segment in segments:
+                    chunk[segment["id"]] = segment["text"]
+                    if len(chunk) == chunk_size:
+                        futures.append(executor.submit(self.safe_call, self.Task, chunk))
+                        chunk = {}
+            if chunk: futures.append(executor.submit(self.safe_call, self.Task, chunk))
+            return [future.result() for future in futures]
+
+    async def atranslate_stream(self, stream: STT.STTServer.SegmentStream) -> list[dict]:
+        """translate_stream的协程版本：在线程里等下一批句段（不阻塞事件循环），每凑够一块就建一个ATask，最多max_workers个块同时在途"""
+        chunk_size = self.settings["chunk_size"]
+        semaphore = asyncio.Semaphore(self.max_workers)
+        segments_iter = iter(stream)
+        tasks = []
+        chunk = {}
+        try:
+            while (segments := await asyncio.to_thread(next, segments_iter, None)) is not None:
+                for segment in segments:
+                    chunk[segment["id"]] = segment["text"]
+                    if len(chunk) == chunk_size:
+                        tasks.append(asyncio.create_task(self.asafe_call(self.ATask, chunk, semaphore)))
+                        chunk = {}
+            if chunk: tasks.append(asyncio.create_task(self.asafe_call(self.ATask, chunk, semaphore)))
+            return list(await asyncio.gather(*tasks))
+        finally: await self.llms.aclose()
+
+    async def amap_chunks(self, afunc, chunks: list[dict]) -> list[dict]:
+        """map_chunks的协程版本，最多max_workers个块同时在途，输出顺序与输入一致"""
+        semaphore = asyncio.Semaphore(self.max_workers)
+        try: return list(await asyncio.gather(*[self.asafe_call(afunc, chunk, semaphore) for chunk in chunks]))
+        finally: await self.llms.aclose()
+
+    @staticmethod
+    async def asafe_call(afunc, chunk: dict, semaphore: asyncio.Semaphore) -> dict:
+        async with semaphore:
+            try: return await afunc(chunk)
+            except Exception as e:
+                logging.error(f"{func_name()}: 处理块失败，保留原文：{e}")
+                return chunk.copy()
+
+    # 以下是Task与PostTask（及其协程版本）共用的提示词拼装、结果解析和查询工具
+
+    def describe(self) -> str:
+        return self.description if self.description else "未提供"
+
+    @staticmethod
+    def prev_context(prev: None|list[dict]) -> str:
+        if not prev: return ""
+        return "\n".join([f"{item.get('id', '')}: {item.get('TranslatedText', '')}" for item in prev[:]])
+
+    @staticmethod
+    def parse_flag(result: dict, field: str) -> bool:
+        """从形如{"field": true}的回复里取出布尔标记，失败则为False"""
+        if not result: return False
+        try: return bool(json.loads(result["content"]).get(field, False))
+        except: return False
+
+    @staticmethod
+    def parse_need_search(result: dict) -> tuple[bool, str, list[str], list[str]]:
+        """解析NEED_SEARCH_PROMPT的回复，返回(need_search, search_type, sentences, keywords)"""
+        need_search = False
+        search_type = "vector"
+        sentences = []
+        keywords = []
+        if result:
+            try:
+                need_data = Formats.Replacing(result["content"], {"": ["\'", "\\'"]})
+                logging.info(need_data)
+                need_data = json.loads(need_data)
+                need_search = need_data.get("need_search", False)
+                search_type = need_data.get("search_type", "vector")
+                query = need_data.get("query", {})
+                sentences = query.get("sentences", [])
+                keywords = query.get("keywords", []) or need_data.get("keywords", [])
+            except Exception as e:
+                logging.warning(f"记忆查询命令提取出错：{e}")
+        return need_search, search_type, sentences, keywords
+
+    @staticmethod
+    def parse_web_query(result: dict) -> str:
+        """解析NEED_WEB_SEARCH_PROMPT的回复，需要上网查时返回查询词，否则返回空字符串"""
+        if not result: return ""
+        try:
+            web_data = json.loads(result["content"])
+            if web_data.get("need_web", False): return web_data.get("query", "") or ""
+        except: pass
+        return ""
+
+    @staticmethod
+    def format_results(search_results: list[dict]) -> str:
+        return "\n".join([f"原文: {r.get('OriginalText', '')} -> 译文: {r.get('TranslatedText', '')}" for r in search_results])
+
+    @staticmethod
+    def strong_format(chunk: dict, field: str, template: str, short_template: str|None=None) -> str:
+        """生成给大模型看的输出格式示例，块较大时只列出首尾几个id。template形如"翻译{}"，{}处填id"""
+        chunklength = len(chunk)
+        if chunklength < 4: return str({ field: {k: (short_template or template).format(k) for k in chunk.keys()} })
+        keys = list(chunk.keys())
+        format_parts = []
+        format_parts.append(f'"{keys[0]}": "{template.format(keys[0])}"')
+        if chunklength >= 2: format_parts.append(f'"{keys[1]}": "{template.format(keys[1])}"')
+        if chunklength > 3: format_parts.append('...')
+        if chunklength >= 3: format_parts.append(f'"{keys[-1]}": "{template.format(keys[-1])}"')
+        return f'{{ "{field}": {{ {", ".join(format_parts)} }} }}'
+
+    @staticmethod
+    def merge_result(chunk: dict, result: dict, field: str) -> dict|None:
+        """把大模型返回的{field: {id: text}}按id填回chunk的副本，解析失败返回None"""
+        if not result: return None
+        result_chunk = chunk.copy()
+        try:
+            data = json.loads(result["content"])
+            for k, v in data.get(field, {}).items():
+                try:
+                    result_chunk[int(k)] = v
+                except:
+                    if k in result_chunk:
+                        result_chunk[k] = v
+            return result_chunk
+        except Exception as e:
+            logging.warning(f"{func_name()}: 解析{field}结果失败: {e}")
+            return None
+
+    @staticmethod
+    def answered_ids(chunk: dict, result: dict, field: str) -> list:
+        """大模型回复里真正给出了非空译文的id。漏掉的id在结果里还是原文，不能当译文存进记忆"""
+        try: data = json.loads(result["content"]).get(field, {})
+        except Exception: return []
+        ids = []
+        for k, v in data.items():
+            try: k = int(k)
+            except: pass
+            if k in chunk and isinstance(v, str) and v.strip(): ids.append(k)
+        return ids
+
+    @staticmethod
+    def parse_plan(result: dict) -> dict|None:
+        """解析融合规划的回复，失败返回None，此时调用方退回逐步判断"""
+        if not result: return None
+        plan = LLMAPI.parse_plan(result["content"])
+        if plan is None: logging.warning(f"{func_name()}: 融合规划结果解析失败，退回逐步判断")
+        return plan
+
+    def plan_msg(self, chunk: dict, context: str) -> list[dict]:
+        return [{"role": "user", "content": LLMAPI.PLAN_PROMPT.format(
+            text=str(chunk),
+            context=context,
+            description=self.describe()
+        )}]
+
+    def check_msg(self, chunk: dict) -> list[dict]:
+        return [{"role": "user", "content": LLMAPI.CHECK_TRANSCRIPTION_PROMPT.format(
+            text=str(chunk),
+            description=self.describe()
+        )}]
+
+    def need_search_msg(self, chunk: dict, context: str) -> list[dict]:
+        return [{"role": "user", "content": LLMAPI.NEED_SEARCH_PROMPT.format(
+            text=str(chunk),
+            context=context,
+            description=self.describe()
+        )}]
+
+    def evaluate_msg(self, chunk: dict, results_text: str) -> list[dict]:
+        return [{"role": "user", "content": LLMAPI.EVALUATE_SEARCH_PROMPT.format(
+            text=str(chunk),
+            results=results_text,
+            description=self.describe()
+        )}]
+
+    def web_msg(self, chunk: dict, retry_count: int) -> list[dict]:
+        return [{"role": "user", "content": LLMAPI.NEED_WEB_SEARCH_PROMPT.format(
+            text=str(chunk),
+            retry_count=retry_count,
+            description=self.describe()
+        )}]
+
+    def translate_msg(self, chunk: dict, context: str, reference_info: str) -> list[dict]:
+        return [{"role": "user", "content": LLMAPI.TRANSLATE_PROMPT.format(
+            reference_info=reference_info if reference_info else "None",
+            text=str(chunk),
+            context=context if context else "None",
+            StrongFormat=self.strong_format(chunk, "translated", "翻译{}", "对先前id{}翻译内容"),
+            description=self.describe()
+        )}]
+
+    def check_refine_msg(self, chunk: dict) -> list[dict]:
+        return [{"role": "user", "content": LLMAPI.CHECK_REFINE_PROMPT.format(text=str(chunk))}]
+
+    def refine_msg(self, chunk: dict, reference_info: str) -> list[dict]:
+        return [{"role": "user", "content": LLMAPI.REFINE_PROMPT.format(
+            reference_info=reference_info if reference_info else "无参考信息",
+            text=str(chunk),
+            StrongFormat=self.strong_format(chunk, "refined", "润色{}"),
+            description=self.describe()
+        )}]
+
+    def search_memory(self, search_type: str, sentences: list[str], keywords: list[str], field: str="OriginalText") -> list[dict]:
+        """第三步的查询：vector用sentences查向量库（按field字段匹配），fulltext用keywords查全文库"""
+        search_results = []
+        if search_type == "vector" and sentences:
+            search_results = self.vdb.search_many([{field: sentence} for sentence in sentences], k=3)
+        elif search_type == "fulltext" and keywords:
+            search_results = self.db.search(keywords, k=3)
+        return search_results
+
+    def reuse_memory(self, chunk: dict) -> dict:
+        """第零步：先按原文精确匹配全文库，没命中的再用向量库找候选，字面相似度（difflib）不低于fuzzy_threshold才算近似命中
+        \n只靠向量相似度会把意思相近但字不同的句子也算进来，所以要再比一次字面。返回{id: 译文}，只含命中的句子"""
+        reuse = self.settings.get("memory_reuse", {})
+        if not reuse.get("enable", True): return {}
+        hits = {}
+        if reuse.get("exact", True):
+            exact = self.db.exact_matches(list(chunk.values()))
+            hits = {k: exact[text] for k, text in chunk.items() if text in exact}
+        exact_count = len(hits)
+
+        fuzzy_threshold = reuse.get("fuzzy_threshold", 0.95)
+        rest = [k for k, text in chunk.items() if k not in hits and len(text.strip()) >= reuse.get("fuzzy_min_length", 4)]
+        if fuzzy_threshold < 1.0 and rest:
+            candidates = self.vdb.nearest([chunk[k] for k in rest], k=3, threshold=reuse.get("vector_threshold", 0.9))
+            for k, row in zip(rest, candidates):
+                # 译文和原文一样的多半是以前翻译失败时存进去的原文，不能复用
+                scored = [(SequenceMatcher(None, chunk[k], c["OriginalText"]).ratio(), c["TranslatedText"]) for c in row if c["TranslatedText"] != c["OriginalText"]]
+                if scored and max(scored)[0] >= fuzzy_threshold: hits[k] = max(scored)[1]
+
+        if hits: logging.info(f"{func_name()}: 翻译记忆命中{len(hits)}/{len(chunk)}句（精确{exact_count}句，近似{len(hits) - exact_count}句）")
+        return hits
+
+    def web_search(self, query: str) -> str:
+        """上网查，返回可以直接放进reference_info的文本，没有结果则返回空字符串"""
+        try:
+            web_results = self.crawler.search(query, max_results=2)
+            if web_results:
+                web_text = "\n".join([f"{r['title']}: {r['snippet']}" for r in web_results])
+                return f"网络搜索结果:\n{web_text}"
+        except: pass
+        return ""
+
+    def save_memory(self, chunk: dict, result_chunk: dict) -> None:
+        """启用memory_writer时交给后台线程批量写入，立即返回"""
+        mem_data = [{"OriginalText": chunk[k], "TranslatedText": result_chunk[k]} for k in chunk.keys()]
+        if not mem_data: return
+        if self.memory is not None: return self.memory.put(mem_data)
+        self.vdb.save(mem_data)
+        self.db.save(mem_data)
+
+    def flush_memory(self) -> None:
+        """等后台把排队的记忆写完。润色要查全部记忆，所以PostTask开始前必须调用"""
+        if self.memory is not None: self.memory.flush()
+
+    def Task(self, chunk, prev: None|list[dict]=None) -> list[dict]:
         """翻译
+        \n第零步：查翻译记忆，原文相同或几乎相同的句子直接复用译文，全部命中就不调用大模型，否则只把剩下的句子（保留id）交给后续步骤
         \n第一步：判断是否有转录错误。有就标记。
         \n第二步：判断是否需要查询历史信息，如果是则判断使用哪个数据库，并给出查询关键词或句子，不需要调用则跳到第七步
         \n第三步：查询
@@ -173,155 +496,136 @@ class Framework:
         \n第七步：根据查询结果和标记信息进行翻译，如果不知道的地方要标记为不知道（幻觉控制）
         \n第八步：输出
         """
-        # text = "\n".join([f"{k}: {v}" for k, v in chunk.items()])
-        context = ""
-        if prev: context = "\n".join([f"{item.get('id', '')}: {item.get('TranslatedText', '')}" for item in prev[:]])
-        
+        # 0
+        full_chunk, hits = chunk, self.reuse_memory(chunk)
+        if len(hits) == len(chunk): return {**chunk, **hits}
+        if hits: chunk = {k: v for k, v in chunk.items() if k not in hits}
+
+        small, large = self.settings["llms"]["SmallModel"], self.settings["llms"]["LargeModelJson"]
+        context = self.prev_context((prev or []) + [{"id": k, "TranslatedText": v} for k, v in hits.items()])
+
+        # 启用fused_planning时，第一、二、五步的判断合并成一次请求，解析失败则plan为None，照常逐步判断
+        plan = None
+        if self.settings.get("fused_planning", False): plan = self.parse_plan(self.llms.req(self.plan_msg(chunk, context), small, stage="plan"))
+
         # 1
-        check_msg = [{"role": "user", "content": LLMAPI.CHECK_TRANSCRIPTION_PROMPT.format(
-            text=str(chunk),
-            description=self.description if self.description else "未提供"
-        )}]
-        check_result = self.llms.req(check_msg, self.settings["llms"]["SmallModel"])
-        has_error = False
-        if check_result:
-            try:
-                check_data = json.loads(check_result["content"])
-                has_error = check_data.get("has_error", False)
-            except: pass
-        
+        if plan is not None: has_error = plan["has_error"]
+        else: has_error = self.parse_flag(self.llms.req(self.check_msg(chunk), small, stage="check"), "has_error")
+
         reference_info = ""
         retry_count = 0
         max_retry = self.settings.get("max_retry", 2)
-        
+
+        # 重试时绕过缓存，否则need_search和evaluate每次都拿到同一个缓存结果，max_retry形同虚设
         while self.settings.get("search_local", True) and retry_count < max_retry:
             # 2
-            need_msg = [{"role": "user", "content": LLMAPI.NEED_SEARCH_PROMPT.format(
-                text=str(chunk), 
-                context=context,
-                description=self.description if self.description else "未提供"
-            )}]
-            need_result = self.llms.req(need_msg, self.settings["llms"]["SmallModel"])
-            
-            need_search = False
-            search_type = "vector"
-            query = {}
-            sentences = []
-            keywords = []
-            
-            if need_result:
-                try:
-                    need_data = Formats.Replacing(need_result["content"], {"": ["\'", "\\'"]})
-                    logging.info(need_data)
-                    need_data = json.loads(need_data)
-                    need_search = need_data.get("need_search", False)
-                    search_type = need_data.get("search_type", "vector")
-                    query = need_data.get("query", {})
-                    sentences = query.get("sentences", [])
-                    keywords = query.get("keywords", [])
-                except Exception as e: 
-                    logging.warning(f"记忆查询命令提取出错：{e}")
-                    pass
-            
+            if plan is not None and retry_count == 0: need_search, search_type, sentences, keywords = plan["need_search"], plan["search_type"], plan["sentences"], plan["keywords"]
+            else: need_search, search_type, sentences, keywords = self.parse_need_search(self.llms.req(self.need_search_msg(chunk, context), small, use_cache=retry_count == 0, stage="need_search"))
             if not need_search: break
-            
+
             # 3
-            search_results = []
-            if search_type == "vector" and sentences:
-                for sentence in sentences:
-                    search_results += self.vdb.search({"OriginalText": sentence}, k=3)
-            elif search_type == "fulltext" and keywords:
-                search_results = self.db.search(keywords, k=3)
-            
+            search_results = self.search_memory(search_type, sentences, keywords)
+
             # 4
             if search_results:
-                results_text = "\n".join([f"原文: {r.get('OriginalText', '')} -> 译文: {r.get('TranslatedText', '')}" for r in search_results])
-                eval_msg = [{"role": "user", "content": LLMAPI.EVALUATE_SEARCH_PROMPT.format(
-                    text=str(chunk), 
-                    results=results_text,
-                    description=self.description if self.description else "未提供"
-                )}]
-                eval_result = self.llms.req(eval_msg, self.settings["llms"]["SmallModel"])
-                
-                useful = False
-                if eval_result:
-                    try:
-                        eval_data = json.loads(eval_result["content"])
-                        useful = eval_data.get("useful", False)
-                    except: pass
-                
-                if useful:
+                results_text = self.format_results(search_results)
+                if self.parse_flag(self.llms.req(self.evaluate_msg(chunk, results_text), small, use_cache=retry_count == 0, stage="evaluate"), "useful"):
                     reference_info = f"参考翻译:\n{results_text}"
                     break
-            
+
             retry_count += 1
-        
+
         # 5&6
         if not reference_info and self.settings.get("Crawler", {}).get("enable_crawler", False):
-            web_msg = [{"role": "user", "content": LLMAPI.NEED_WEB_SEARCH_PROMPT.format(
-                text=str(chunk), 
-                retry_count=retry_count,
-                description=self.description if self.description else "未提供"
-            )}]
-            web_result = self.llms.req(web_msg, self.settings["llms"]["SmallModel"])
-            
-            if web_result:
-                try:
-                    web_data = json.loads(web_result["content"])
-                    if web_data.get("need_web", False):
-                        query = web_data.get("query", "")
-                        if query:
-                            web_results = self.crawler.search(query, max_results=2)
-                            if web_results:
-                                web_text = "\n".join([f"{r['title']}: {r['snippet']}" for r in web_results])
-                                reference_info = f"网络搜索结果:\n{web_text}"
-                except: pass
-        
+            if plan is not None: query = plan["web_query"] if plan["need_web"] else ""
+            else: query = self.parse_web_query(self.llms.req(self.web_msg(chunk, retry_count), small, stage="web"))
+            if query: reference_info = self.web_search(query)
+
         # 7
-        chunklength = len(chunk)
-        if chunklength < 4: StrongFormat = str({ "translated": {k: f"对先前id{k}翻译内容" for k in chunk.keys()} })
-        else:
-            keys = list(chunk.keys())
-            format_parts = []
-            format_parts.append(f'"{keys[0]}": "翻译{keys[0]}"')
-            if chunklength >= 2: format_parts.append(f'"{keys[1]}": "翻译{keys[1]}"')
-            if chunklength > 3: format_parts.append('...')
-            if chunklength >= 3: format_parts.append(f'"{keys[-1]}": "翻译{keys[-1]}"')
-            StrongFormat = f'{{ "translated": {{ {", ".join(format_parts)} }} }}'
-            
-        translate_msg = [{"role": "user", "content": LLMAPI.TRANSLATE_PROMPT.format(
-            reference_info=reference_info if reference_info else "None",
-            text=str(chunk),
-            context=context if context else "None",
-            StrongFormat=StrongFormat,
-            description=self.description if self.description else "未提供"
-        )}]
-        for _ in range(10):
-            translate_result = self.llms.req(translate_msg, self.settings["llms"]["LargeModelJson"])
-            
+        translate_msg = self.translate_msg(chunk, context, reference_info)
+        result_chunk = chunk.copy()
+        translated_ids = [] # 翻译失败时result_chunk保留原文，只有这些id的译文可以存进记忆
+        for attempt in range(self.settings.get("retry", {}).get("max_parse_attempts", 10)):
+            # 重试时绕过缓存，否则会一直拿到同一个解析不了的结果
+            translate_result = self.llms.req(translate_msg, large, use_cache=attempt == 0, stage="translate")
+            if not translate_result: break # req内部已按重试策略重试过，再请求只会继续消耗配额，保留原文
+
             # 8
-            result_chunk = chunk.copy()
-            if translate_result:
-                try:
-                    translate_data = json.loads(translate_result["content"])
-                    translated = translate_data.get("translated", {})
-                    for k, v in translated.items():
-                        try:
-                            result_chunk[int(k)] = v
-                        except:
-                            if k in result_chunk:
-                                result_chunk[k] = v
+            merged = self.merge_result(chunk, translate_result, "translated")
+            if merged is not None:
+                result_chunk = merged
+                translated_ids = self.answered_ids(chunk, translate_result, "translated")
+                break
+
+        self.save_memory({k: chunk[k] for k in translated_ids}, result_chunk)
+        return {**full_chunk, **result_chunk, **hits}
+
+    async def ATask(self, chunk, prev: None|list[dict]=None) -> list[dict]:
+        """Task的协程版本，步骤完全相同。LLM请求走areq，数据库与爬虫放到线程里执行"""
+        # 0
+        full_chunk, hits = chunk, await asyncio.to_thread(self.reuse_memory, chunk)
+        if len(hits) == len(chunk): return {**chunk, **hits}
+        if hits: chunk = {k: v for k, v in chunk.items() if k not in hits}
+
+        small, large = self.settings["llms"]["SmallModel"], self.settings["llms"]["LargeModelJson"]
+        context = self.prev_context((prev or []) + [{"id": k, "TranslatedText": v} for k, v in hits.items()])
+
+        # 启用fused_planning时，第一、二、五步的判断合并成一次请求，解析失败则plan为None，照常逐步判断
+        plan = None
+        if self.settings.get("fused_planning", False): plan = self.parse_plan(await self.llms.areq(self.plan_msg(chunk, context), small, stage="plan"))
+
+        # 1
+        if plan is not None: has_error = plan["has_error"]
+        else: has_error = self.parse_flag(await self.llms.areq(self.check_msg(chunk), small, stage="check"), "has_error")
+
+        reference_info = ""
+        retry_count = 0
+        max_retry = self.settings.get("max_retry", 2)
+
+        # 重试时绕过缓存，否则need_search和evaluate每次都拿到同一个缓存结果，max_retry形同虚设
+        while self.settings.get("search_local", True) and retry_count < max_retry:
+            # 2
+            if plan is not None and retry_count == 0: need_search, search_type, sentences, keywords = plan["need_search"], plan["search_type"], plan["sentences"], plan["keywords"]
+            else: need_search, search_type, sentences, keywords = self.parse_need_search(await self.llms.areq(self.need_search_msg(chunk, context), small, use_cache=retry_count == 0, stage="need_search"))
+            if not need_search: break
+
+            # 3
+            search_results = await asyncio.to_thread(self.search_memory, search_type, sentences, keywords)
+
+            # 4
+            if search_results:
+                results_text = self.format_results(search_results)
+                if self.parse_flag(await self.llms.areq(self.evaluate_msg(chunk, results_text), small, use_cache=retry_count == 0, stage="evaluate"), "useful"):
+                    reference_info = f"参考翻译:\n{results_text}"
                     break
-                except Exception as e:
-                    logging.warning(f"{func_name()}: 解析翻译结果失败: {e}")
-        
-        mem_data = [{"OriginalText": chunk[k], "TranslatedText": result_chunk[k]} for k in chunk.keys()]
-        self.vdb.save(mem_data)
-        self.db.save(mem_data)
-        
-        return result_chunk
 
-    def PostTask(self, chunk) -> list[dict]: 
+            retry_count += 1
+
+        # 5&6
+        if not reference_info and self.settings.get("Crawler", {}).get("enable_crawler", False):
+            if plan is not None: query = plan["web_query"] if plan["need_web"] else ""
+            else: query = self.parse_web_query(await self.llms.areq(self.web_msg(chunk, retry_count), small, stage="web"))
+            if query: reference_info = await asyncio.to_thread(self.web_search, query)
+
+        # 7
+        translate_msg = self.translate_msg(chunk, context, reference_info)
+        result_chunk = chunk.copy()
+        translated_ids = [] # 翻译失败时result_chunk保留原文，只有这些id的译文可以存进记忆
+        for attempt in range(self.settings.get("retry", {}).get("max_parse_attempts", 10)):
+            translate_result = await self.llms.areq(translate_msg, large, use_cache=attempt == 0, stage="translate")
+            if not translate_result: break
+
+            # 8
+            merged = self.merge_result(chunk, translate_result, "translated")
+            if merged is not None:
+                result_chunk = merged
+                translated_ids = self.answered_ids(chunk, translate_result, "translated")
+                break
+
+        await asyncio.to_thread(self.save_memory, {k: chunk[k] for k in translated_ids}, result_chunk)
+        return {**full_chunk, **result_chunk, **hits}
+
+    def PostTask(self, chunk) -> list[dict]:
         """润色，待所有字幕文件翻译完毕后调用
         \n第一步：检查标记内容、通顺性、谬误，如果没有问题则跳到第六步
         \n第二步：判断调用哪个数据库，并给出查询关键词或句子，不需要调用则跳到第四步
@@ -330,119 +634,100 @@ class Framework:
         \n第五步：根据查询结果润色，未解决的标记要保留
         \n第六步：输出
         """
-        
+        small, large = self.settings["llms"]["SmallModel"], self.settings["llms"]["LargeModelJson"]
+
         # 1
-        check_msg = [{"role": "user", "content": LLMAPI.CHECK_REFINE_PROMPT.format(text=str(chunk))}]
-        check_result = self.llms.req(check_msg, self.settings["llms"]["SmallModel"])
-        
-        has_issue = False
-        if check_result:
-            try:
-                check_data = json.loads(check_result["content"])
-                has_issue = check_data.get("has_issue", False)
-            except: pass
-        
+        has_issue = self.parse_flag(self.llms.req(self.check_refine_msg(chunk), small, stage="refine_check"), "has_issue")
+
         reference_info = ""
-        
+
         # 2
         if has_issue:
             retry_count = 0
             max_retry = self.settings.get("max_retry", 2)
-            
+
+            # 重试时绕过缓存，理由同Task
             while self.settings.get("search_local", True) and retry_count < max_retry:
-                need_msg = [{"role": "user", "content": LLMAPI.NEED_SEARCH_PROMPT.format(
-                    text=str(chunk), 
-                    context="",
-                    description=self.description if self.description else "未提供"
-                )}]
-                need_result = self.llms.req(need_msg, self.settings["llms"]["SmallModel"])
-                
-                need_search = False
-                search_type = "vector"
-                keywords = []
-                
-                if need_result:
-                    try:
-                        need_data = json.loads(need_result["content"])
-                        need_search = need_data.get("need_search", False)
-                        search_type = need_data.get("search_type", "vector")
-                        keywords = need_data.get("keywords", [])
-                    except: pass
-                
+                need_search, search_type, _, keywords = self.parse_need_search(self.llms.req(self.need_search_msg(chunk, ""), small, use_cache=retry_count == 0, stage="refine_search"))
                 if not need_search: break
-                
+
                 # 3
-                search_results = []
-                if search_type == "vector" and keywords:
-                    query_text = " ".join(keywords)
-                    search_results = self.vdb.search({"TranslatedText": query_text}, k=3)
-                elif search_type == "fulltext" and keywords:
-                    search_results = self.db.search(keywords, k=3)
-                
+                search_results = self.search_memory(search_type, [" ".join(keywords)] if keywords else [], keywords, "TranslatedText")
+
                 # 4
                 if search_results:
-                    results_text = "\n".join([f"原文: {r.get('OriginalText', '')} -> 译文: {r.get('TranslatedText', '')}" for r in search_results])
-                    eval_msg = [{"role": "user", "content": LLMAPI.EVALUATE_SEARCH_PROMPT.format(
-                        text=str(chunk), 
-                        results=results_text,
-                        description=self.description if self.description else "未提供"
-                    )}]
-                    eval_result = self.llms.req(eval_msg, self.settings["llms"]["SmallModel"])
-                    
-                    useful = False
-                    if eval_result:
-                        try:
-                            eval_data = json.loads(eval_result["content"])
-                            useful = eval_data.get("useful", False)
-                        except: pass
-                    
-                    if useful:
+                    results_text = self.format_results(search_results)
+                    if self.parse_flag(self.llms.req(self.evaluate_msg(chunk, results_text), small, use_cache=retry_count == 0, stage="refine_evaluate"), "useful"):
                         reference_info = f"参考翻译:\n{results_text}"
                         break
-                
+
                 retry_count += 1
-        
+
         # 5
-        chunklength = len(chunk)
-        if chunklength < 4: StrongFormat = str({ "refined": {k: f"润色{k}" for k in chunk.keys()} })
-        else:
-            keys = list(chunk.keys())
-            format_parts = []
-            format_parts.append(f'"{keys[0]}": "润色{keys[0]}"')
-            if chunklength >= 2: format_parts.append(f'"{keys[1]}": "润色{keys[1]}"')
-            if chunklength > 3: format_parts.append('...')
-            if chunklength >= 3: format_parts.append(f'"{keys[-1]}": "润色{keys[-1]}"')
-            StrongFormat = f'{{ "refined": {{ {", ".join(format_parts)} }} }}'
-            
-        refine_msg = [{"role": "user", "content": LLMAPI.REFINE_PROMPT.format(
-            reference_info=reference_info if reference_info else "无参考信息",
-            text=str(chunk),
-            StrongFormat=StrongFormat,
-            description=self.description if self.description else "未提供"
-        )}]
+        refine_msg = self.refine_msg(chunk, reference_info)
+        result_chunk = chunk.copy()
+        for attempt in range(self.settings.get("retry", {}).get("max_parse_attempts", 10)):
+            refine_result = self.llms.req(refine_msg, large, use_cache=attempt == 0, stage="refine")
+            if not refine_result: break
 
-        for _ in range(10):
-            refine_result = self.llms.req(refine_msg, self.settings["llms"]["LargeModelJson"])
-            
             # 6
-            result_chunk = chunk.copy()
-            if refine_result:
-                try:
-                    refine_data = json.loads(refine_result["content"])
-                    refined = refine_data.get("refined", {})
-                    for k, v in refined.items():
-                        try:
-                            result_chunk[int(k)] = v
-                        except:
-                            if k in result_chunk:
-                                result_chunk[k] = v
-                    break
-                except Exception as e:
-                    logging.warning(f"解析润色结果失败：{e}")
-        
+            merged = self.merge_result(chunk, refine_result, "refined")
+            if merged is not None:
+                result_chunk = merged
+                break
+
+        return result_chunk
+
+    async def APostTask(self, chunk) -> list[dict]:
+        """PostTask的协程版本，步骤完全相同"""
+        small, large = self.settings["llms"]["SmallModel"], self.settings["llms"]["LargeModelJson"]
+
+        # 1
+        has_issue = self.parse_flag(await self.llms.areq(self.check_refine_msg(chunk), small, stage="refine_check"), "has_issue")
+
+        reference_info = ""
+
+        # 2
+        if has_issue:
+            retry_count = 0
+            max_retry = self.settings.get("max_retry", 2)
+
+            # 重试时绕过缓存，理由同Task
+            while self.settings.get("search_local", True) and retry_count < max_retry:
+                need_search, search_type, _, keywords = self.parse_need_search(await self.llms.areq(self.need_search_msg(chunk, ""), small, use_cache=retry_count == 0, stage="refine_search"))
+                if not need_search: break
+
+                # 3
+                search_results = await asyncio.to_thread(self.search_memory, search_type, [" ".join(keywords)] if keywords else [], keywords, "TranslatedText")
+
+                # 4
+                if search_results:
+                    results_text = self.format_results(search_results)
+                    if self.parse_flag(await self.llms.areq(self.evaluate_msg(chunk, results_text), small, use_cache=retry_count == 0, stage="refine_evaluate"), "useful"):
+                        reference_info = f"参考翻译:\n{results_text}"
+                        break
+
+                retry_count += 1
+
+        # 5
+        refine_msg = self.refine_msg(chunk, reference_info)
+        result_chunk = chunk.copy()
+        for attempt in range(self.settings.get("retry", {}).get("max_parse_attempts", 10)):
+            refine_result = await self.llms.areq(refine_msg, large, use_cache=attempt == 0, stage="refine")
+            if not refine_result: break
+
+            # 6
+            merged = self.merge_result(chunk, refine_result, "refined")
+            if merged is not None:
+                result_chunk = merged
+                break
+
         return result_chunk
 
     def quit(self):
         """把资源清一清"""
-        self.db.clear()
-        self.vdb.__del__()
\ No newline at end of file
+        if self.memory is not None: self.memory.close()
+        if not self.tm_persistent: self.db.clear()
+        self.vdb.persist()
+        self.vdb.__del__()
+        LLMAPI.close_clients()
\ No newline at end of file
@@ -1,5 +1,6 @@
-import openai, os, logging, json
-import sys
+import openai, httpx, os, logging, json
+import sys, threading, asyncio, weakref, hashlib, sqlite3, time, random, collections
+from email.utils import parsedate_to_datetime
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from lib_helper import load_json_with_comments, func_name
 
@@ -157,44 +158,608 @@ CHECK_REFINE_PROMPT = """检查以下翻译是否存在问题(转录错误、不
 只返回JSON,不要其他内容。"""
 
 
+PLAN_PROMPT = """
+你是字幕翻译的规划助手。
+以下是对待翻译内容的简介：
+{description}
+
+现在，请对以下转录文本一次性完成三项判断：
+1. 是否存在明显的转录错误(如乱码、不合理的重复、不通顺等)
+2. 翻译时是否需要查询历史翻译记录，例如人名、专业术语等。如果需要，search_type为vector时提供sentences，为fulltext时提供keywords
+3. 如果历史翻译记录可能不够用，是否需要进行网络搜索来获取更多信息，需要则给出搜索关键词
+
+原文:
+{text}
+
+上下文(可能为空):
+{context}
+
+返回严格的JSON，格式如下:
+{{"has_error": false, "need_search": true, "search_type": "vector或fulltext", "query": {{"keywords": ["keyword1", ...], "sentences": ["sentence1", ...]}}, "need_web": false, "web_query": "搜索关键词"}}
+不需要查询时query可以为空对象，不需要网络搜索时web_query可以为空字符串。
+
+我们鼓励你多进行查询以获取足够的信息。并且，查询索引、关键词或依据等建议使用原本未翻译的语言以保证足够精确。
+只返回JSON,不要其他内容。"""
+
+
+# PLAN_PROMPT回复的结构，parse_plan按此校验。search_type的enum只在need_search为true时检查
+PLAN_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "has_error": {"type": "boolean"},
+        "need_search": {"type": "boolean"},
+        "search_type": {"type": "string", "enum": ["vector", "fulltext"]},
+        "query": {
+            "type": "object",
+            "properties": {
+                "keywords": {"type": "array", "items": {"type": "string"}},
+                "sentences": {"type": "array", "items": {"type": "string"}}
+            }
+        },
+        "need_web": {"type": "boolean"},
+        "web_query": {"type": "string"}
+    },
+    "required": ["has_error", "need_search", "need_web"]
+}
+
+_JSON_TYPES = {"object": dict, "array": list, "string": str, "boolean": bool}
+
+def _matches(data, schema: dict) -> bool:
+    """只支持PLAN_SCHEMA用到的那部分JSON Schema"""
+    if not isinstance(data, _JSON_TYPES[schema["type"]]): return False
+    if "enum" in schema and data not in schema["enum"]: return False
+    if schema["type"] == "array": return all(_matches(item, schema["items"]) for item in data)
+    if schema["type"] == "object":
+        if any(field not in data for field in schema.get("required", [])): return False
+        return all(_matches(data[field], sub) for field, sub in schema.get("properties", {}).items() if field in data)
+    return True
+
+def parse_plan(content: str) -> dict|None:
+    """解析PLAN_PROMPT的回复并补全默认值，不符合PLAN_SCHEMA则返回None"""
+    try: data = json.loads(content)
+    except Exception: return None
+    # 不查询时search_type用不上，模型常照抄"vector或fulltext"占位符或给空串，不能因此作废整个规划
+    if isinstance(data, dict) and data.get("need_search") is not True: data.pop("search_type", None)
+    if not _matches(data, PLAN_SCHEMA): return None
+    query = data.get("query", {})
+    return {
+        "has_error": data["has_error"],
+        "need_search": data["need_search"],
+        "search_type": data.get("search_type", "vector"),
+        "sentences": query.get("sentences", []),
+        "keywords": query.get("keywords", []),
+        "need_web": data["need_web"],
+        "web_query": data.get("web_query", "")
+    }
+
+
+# 每个API端点的并发上限，跨LLM实例共享
+_endpoint_slots: dict[str, threading.BoundedSemaphore] = {}
+_endpoint_slots_lock = threading.Lock()
+
+def endpoint_slot(settings: dict) -> threading.BoundedSemaphore:
+    """按api_base取得该端点的并发信号量，上限为settings中的max_concurrency（默认4）
+    \n同一端点以第一次见到的max_concurrency为准"""
+    key = settings.get("api_base", "")
+    with _endpoint_slots_lock:
+        if key not in _endpoint_slots:
+            _endpoint_slots[key] = threading.BoundedSemaphore(max(1, int(settings.get("max_concurrency", 4))))
+        return _endpoint_slots[key]
+
+
+# 按(api_base, api_key)缓存的客户端，复用keep-alive连接池，跨线程共享（httpx.Client是线程安全的）
+_clients: dict[tuple[str, str], openai.OpenAI] = {}
+_clients_lock = threading.Lock()
+
+def get_client(settings: dict, client_settings: dict|None=None) -> openai.OpenAI:
+    """取得某端点的共享客户端，没有就新建一个。client_settings见settings.json中的llm_client"""
+    key = (settings.get("api_base", ""), settings.get("api_key", ""))
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            cs = client_settings or {}
+            http_client = httpx.Client(
+                limits=httpx.Limits(
+                    max_connections=cs.get("max_connections", 32),
+                    max_keepalive_connections=cs.get("max_keepalive_connections", 16),
+                    keepalive_expiry=cs.get("keepalive_expiry", 60)
+                ),
+                timeout=httpx.Timeout(cs.get("timeout", 120), connect=cs.get("connect_timeout", 10))
+            )
+            # 重试由RetryPolicy统一负责，关掉SDK自带的重试以免叠加
+            client = openai.OpenAI(api_key=key[1], base_url=key[0], http_client=http_client, max_retries=0)
+            _clients[key] = client
+        return client
+
+def close_clients() -> None:
+    """关闭所有缓存的客户端及其连接池"""
+    with _clients_lock:
+        for client in _clients.values():
+            try: client.close()
+            except Exception as e: logging.debug(f"{func_name()}: {e}")
+        _clients.clear()
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        """容量为per_minute、每秒补充per_minute/60的令牌桶"""
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, n: float) -> float:
+        """尝试取出n个令牌。取到返回0，否则返回还需等待的秒数（此时不扣令牌）
+        \n超过容量的请求在桶满时放行，避免永远等不到"""
+        with self._lock:
+            self._refill()
+            if self.tokens >= min(n, self.capacity):
+                self.tokens -= n
+                return 0.0
+            return (min(n, self.capacity) - self.tokens) / self.rate
+
+    def adjust(self, n: float) -> None:
+        """按实际用量补扣（n为负则退还）"""
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens - n)
+
+
+class RateLimiter:
+    def __init__(self):
+        """按模型配置（api_base, model）分别维护每分钟请求数（rpm）与每分钟token数（tpm）两个令牌桶
+        \n限额取自该配置的rpm、tpm字段，为0或缺省表示不限"""
+        self._buckets: dict[tuple[str, str], tuple[TokenBucket|None, TokenBucket|None]] = {}
+        self._lock = threading.Lock()
+
+    def buckets(self, settings: dict) -> tuple[TokenBucket|None, TokenBucket|None]:
+        key = (settings.get("api_base", ""), settings.get("model", ""))
+        with self._lock:
+            if key not in self._buckets:
+                rpm, tpm = settings.get("rpm", 0), settings.get("tpm", 0)
+                self._buckets[key] = (TokenBucket(rpm) if rpm else None, TokenBucket(tpm) if tpm else None)
+            return self._buckets[key]
+
+    def reserve(self, settings: dict, tokens: int) -> float:
+        """同时从两个桶取令牌，返回需等待的秒数；只要有一个桶不够就都不扣"""
+        rpm, tpm = self.buckets(settings)
+        wait = rpm.reserve(1) if rpm else 0.0
+        if wait: return wait
+        wait = tpm.reserve(tokens) if tpm else 0.0
+        if wait and rpm: rpm.adjust(-1)
+        return wait
+
+    def acquire(self, settings: dict, tokens: int) -> None:
+        while (wait := self.reserve(settings, tokens)) > 0: time.sleep(wait)
+
+    async def aacquire(self, settings: dict, tokens: int) -> None:
+        while (wait := self.reserve(settings, tokens)) > 0: await asyncio.sleep(wait)
+
+    def settle(self, settings: dict, estimated: int, actual: int) -> None:
+        """请求完成后用usage里的真实token数修正预估"""
+        _, tpm = self.buckets(settings)
+        if tpm: tpm.adjust(actual - estimated)
+
+# 限额是服务商按账号算的，所以所有LLM实例共用一个
+rate_limiter = RateLimiter()
+
+def estimate_tokens(messagelist: list[dict]) -> int:
+    """粗略估计prompt的token数，中日文大约一字一token，英文约四字符一token，这里取折中"""
+    return sum(len(str(message.get("content", ""))) for message in messagelist) // 2 + 1
+
+
+class UsageMeter:
+    def __init__(self):
+        """按(文件, 阶段)累计prompt与completion的token数和请求数"""
+        self._usage: dict[tuple[str, str], dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, file: str, stage: str, prompt_tokens: int, completion_tokens: int) -> None:
+        with self._lock:
+            usage = self._usage.setdefault((file, stage), { "requests": 0, "prompt_tokens": 0, "completion_tokens": 0 })
+            usage["requests"] += 1
+            usage["prompt_tokens"] += prompt_tokens
+            usage["completion_tokens"] += completion_tokens
+
+    def summary(self, file: str|None=None, by: str="stage") -> dict[str, dict[str, int]]:
+        """按阶段（by="stage"）或按文件（by="file"）汇总；给出file时只统计该文件"""
+        result = {}
+        with self._lock:
+            for (f, stage), usage in self._usage.items():
+                if file is not None and f != file: continue
+                total = result.setdefault(stage if by == "stage" else f, { "requests": 0, "prompt_tokens": 0, "completion_tokens": 0 })
+                for k in total: total[k] += usage[k]
+        return result
+
+
+class ResponseParseError(Exception):
+    """要求JSON输出（response_format）的请求返回了无法解析的内容"""
+
+
+class RetryPolicy:
+    def __init__(self, settings: dict|None=None):
+        """请求失败时的重试策略：按错误类型决定是否重试，指数退避加抖动，优先遵守Retry-After（超过max_delay则放弃），
+        \n另外每个端点有一个熔断器：连续失败breaker_threshold次后breaker_cooldown秒内暂停发请求，请求方等到冷却结束再试
+        \n限流（429）不算熔断器的失败，它由Retry-After和RPM/TPM限速器处理
+        \nretry_budget是每分钟内所有请求加起来最多的重试次数，防止限流时重试风暴"""
+        settings = settings or {}
+        self.max_attempts = max(1, int(settings.get("max_attempts", 4)))
+        self.base_delay = settings.get("base_delay", 1.0)
+        self.max_delay = settings.get("max_delay", 30.0)
+        self.retry_budget = settings.get("retry_budget", 60)
+        self.breaker_threshold = settings.get("breaker_threshold", 5)
+        self.breaker_cooldown = settings.get("breaker_cooldown", 60.0)
+        self._lock = threading.Lock()
+        self._breakers: dict[str, dict] = {}
+        self._retries = collections.deque()
+
+    @staticmethod
+    def classify(e: Exception) -> str|None:
+        """返回rate_limit、server、timeout、parse之一，不值得重试的错误返回None"""
+        if isinstance(e, ResponseParseError): return "parse"
+        if isinstance(e, openai.RateLimitError): return "rate_limit"
+        if isinstance(e, (openai.APITimeoutError, openai.APIConnectionError, asyncio.TimeoutError)): return "timeout"
+        if isinstance(e, openai.APIStatusError):
+            if e.status_code == 429: return "rate_limit"
+            if e.status_code >= 500: return "server"
+        return None
+
+    @staticmethod
+    def retry_after(e: Exception) -> float|None:
+        response = getattr(e, "response", None)
+        headers = getattr(response, "headers", None)
+        if not headers: return None
+        try:
+            if headers.get("retry-after-ms"): return float(headers["retry-after-ms"]) / 1000
+            value = headers.get("retry-after")
+            if not value: return None
+            try: return float(value)
+            except ValueError: return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except Exception: return None
+
+    def delay(self, attempt: int, e: Exception) -> float|None:
+        """第attempt次（从0开始）失败后应等待的秒数。服务器要求等的比max_delay还久时返回None，不再重试"""
+        retry_after = self.retry_after(e)
+        if retry_after is not None: return retry_after if retry_after <= self.max_delay else None
+        cap = min(self.max_delay, self.base_delay * (2 ** attempt))
+        return cap / 2 + random.uniform(0, cap / 2)
+
+    def take_retry(self) -> bool:
+        """从每分钟的重试预算里取一次，预算用完返回False"""
+        now = time.monotonic()
+        with self._lock:
+            while self._retries and now - self._retries[0] > 60: self._retries.popleft()
+            if len(self._retries) >= self.retry_budget: return False
+            self._retries.append(now)
+            return True
+
+    def open_for(self, endpoint: str) -> float:
+        """熔断器还要打开多少秒，没打开为0；冷却结束后放行（半开），下一次结果决定是否重新打开"""
+        with self._lock:
+            breaker = self._breakers.get(endpoint)
+            return 0.0 if breaker is None else max(0.0, breaker["open_until"] - time.monotonic())
+
+    def record(self, endpoint: str, ok: bool) -> None:
+        with self._lock:
+            breaker = self._breakers.setdefault(endpoint, { "failures": 0, "open_until": 0.0 })
+            if ok:
+                breaker["failures"] = 0
+                return
+            breaker["failures"] += 1
+            if breaker["failures"] >= self.breaker_threshold:
+                breaker["open_until"] = time.monotonic() + self.breaker_cooldown
+                logging.warning(f"{func_name()}: {endpoint} 连续失败{breaker['failures']}次，熔断{self.breaker_cooldown}秒")
+
+    def on_error(self, endpoint: str, attempt: int, e: Exception) -> float|None:
+        """记录一次失败，返回重试前应等待的秒数；不应再重试时返回None"""
+        kind = self.classify(e)
+        if kind not in ["parse", "rate_limit"]: self.record(endpoint, False)
+        if kind is None or attempt + 1 >= self.max_attempts: return None
+        delay = self.delay(attempt, e)
+        if delay is None:
+            logging.warning(f"{func_name()}: 请求失败（{kind}）：{e}，Retry-After超过max_delay，不再重试")
+            return None
+        if not self.take_retry(): return None
+        logging.warning(f"{func_name()}: 请求失败（{kind}）：{e}，{delay:.1f}秒后第{attempt + 1}次重试")
+        return delay
+
+
+class ResponseCache:
+    def __init__(self, path="./Tools/LLMCache.db", max_entries: int=50000, ttl: float=0):
+        """以请求内容的哈希为键的磁盘响应缓存。ttl为秒，0表示不过期；条目数超过max_entries时淘汰最久未访问的"""
+        self.path = os.path.normpath(path)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    content TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    accessed REAL NOT NULL
+                )
+            ''')
+            self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses(accessed)")
+            self.conn.commit()
+
+    @staticmethod
+    def make_key(messagelist: list[dict], settings: dict) -> str:
+        payload = json.dumps([
+            settings.get("model", ""),
+            settings.get("api_base", ""),
+            settings.get("temperature", 1.0),
+            settings.get("response_format", None),
+            messagelist
+        ], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str|None:
+        now = time.time()
+        with self._lock:
+            row = self.conn.execute("SELECT content, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row and self.ttl and now - row[1] > self.ttl:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.conn.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, content: str) -> None:
+        now = time.time()
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, content, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, content, now, now)
+            )
+            self._puts += 1
+            if self._puts % 100 == 0: self._evict(now)
+            self.conn.commit()
+
+    def _evict(self, now: float) -> None:
+        """调用方需持有锁"""
+        if self.ttl: self.conn.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+        count = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        if count > self.max_entries:
+            self.conn.execute('''
+                DELETE FROM responses WHERE key IN (
+                    SELECT key FROM responses ORDER BY accessed LIMIT ?
+                )
+            ''', (count - self.max_entries,))
+            logging.info(f"{func_name()}: 淘汰了 {count - self.max_entries} 条缓存")
+
+    def clear(self) -> None:
+        with self._lock:
+            self.conn.execute("DELETE FROM responses")
+            self.conn.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            count = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return { "hits": self.hits, "misses": self.misses, "entries": count }
+
+
 class LLM:
     def __init__(self):
         settingsPath = os.path.normpath("settings.json")
-        self.settings = load_json_with_comments(settingsPath)["llms"]
+        settings = load_json_with_comments(settingsPath)
+        self.settings = settings["llms"]
+        self.client_settings = settings.get("llm_client", {})
+        self._async_states = weakref.WeakKeyDictionary()
+        self.retry = RetryPolicy(settings.get("retry", {}))
+        self.usage = UsageMeter()
+        self.current_file = "" # 由Framework在处理每个文件前设置，用于按文件统计token
+        cache_settings = settings.get("llm_cache", {})
+        self.cache = None
+        if cache_settings.get("enable", False):
+            try:
+                self.cache = ResponseCache(
+                    cache_settings.get("path", "./Tools/LLMCache.db"),
+                    cache_settings.get("max_entries", 50000),
+                    cache_settings.get("ttl", 0)
+                )
+            except Exception as e: logging.warning(f"{func_name()}: 响应缓存初始化失败，不使用缓存：{e}")
 
-    def req(self, messagelist: list[dict], settings: dict) -> dict:
+    def req(self, messagelist: list[dict], settings: dict, use_cache: bool=True, stage: str="") -> dict:
         """调用OpenAI兼容的API,输入为openai格式的messagelist以及settings字典(见settings.json)
         \n返回结果为 { "role": "assistant", "content": "..."} 格式的字典
-        \n如果调用失败则返回空字典{}"""
+        \n如果调用失败则返回空字典{}
+        \nuse_cache为False时跳过缓存查找（结果仍会写入缓存，覆盖旧的）
+        \nstage是调用方所处的步骤名，仅用于token统计"""
         logging.debug(f"{messagelist}")
-        try:
-            client = openai.OpenAI(api_key=settings["api_key"], base_url=settings["api_base"])
-            if settings.get("response_format", False):
-                try:
-                    completion = client.chat.completions.create(
-                        model=settings["model"],
-                        messages=messagelist,
-                        temperature=settings.get("temperature", 1.0),
-                        response_format=settings["response_format"]
-                    )
-                except Exception as e:
-                    completion = client.chat.completions.create(
-                        model=settings["model"],
-                        messages=messagelist,
-                        temperature=settings.get("temperature", 1.0)
-                    )
-            else:
-                completion = client.chat.completions.create(
-                    model=settings["model"],
-                    messages=messagelist,
-                    temperature=settings.get("temperature", 1.0)
-                )
-        except Exception as e:
-            logging.error(f"{func_name()}: {e}")
-            return {}
+        key, cached = self._lookup(messagelist, settings, use_cache)
+        if cached: return cached
+        endpoint = settings.get("api_base", "")
+        estimated = estimate_tokens(messagelist)
+        for attempt in range(self.retry.max_attempts):
+            wait = self.retry.open_for(endpoint)
+            if wait > 0:
+                logging.warning(f"{func_name()}: {endpoint} 处于熔断状态，{wait:.0f}秒后再请求")
+                time.sleep(wait)
+            try:
+                rate_limiter.acquire(settings, estimated)
+                with endpoint_slot(settings): completion = self._create(messagelist, settings)
+                self._account(completion, settings, estimated, stage)
+                result = self._finish(completion, key, settings)
+            except Exception as e:
+                delay = self.retry.on_error(endpoint, attempt, e)
+                if delay is None:
+                    logging.error(f"{func_name()}: {e}")
+                    return {}
+                time.sleep(delay)
+                continue
+            self.retry.record(endpoint, True)
+            return result
+        return {}
+
+    async def areq(self, messagelist: list[dict], settings: dict, use_cache: bool=True, timeout: float|None=None, stage: str="") -> dict:
+        """req的协程版本，返回格式相同。同一端点同时在途的请求数受max_concurrency限制
+        \ntimeout为单次请求（含排队）的秒数上限，超时按timeout错误重试；任务被取消时CancelledError照常向上抛出"""
+        logging.debug(f"{messagelist}")
+        key, cached = self._lookup(messagelist, settings, use_cache)
+        if cached: return cached
+        endpoint = settings.get("api_base", "")
+        estimated = estimate_tokens(messagelist)
+        for attempt in range(self.retry.max_attempts):
+            wait = self.retry.open_for(endpoint)
+            if wait > 0:
+                logging.warning(f"{func_name()}: {endpoint} 处于熔断状态，{wait:.0f}秒后再请求")
+                await asyncio.sleep(wait)
+            try:
+                await rate_limiter.aacquire(settings, estimated)
+                completion = await asyncio.wait_for(self._acreate_limited(messagelist, settings), timeout)
+                self._account(completion, settings, estimated, stage)
+                result = self._finish(completion, key, settings)
+            except Exception as e:
+                delay = self.retry.on_error(endpoint, attempt, e)
+                if delay is None:
+                    logging.error(f"{func_name()}: {e}")
+                    return {}
+                await asyncio.sleep(delay)
+                continue
+            self.retry.record(endpoint, True)
+            return result
+        return {}
+
+    def _lookup(self, messagelist: list[dict], settings: dict, use_cache: bool) -> tuple[str|None, dict]:
+        """返回(缓存键, 命中的结果)。未启用缓存时键为None，未命中时结果为{}"""
+        if self.cache is None: return None, {}
+        key = ResponseCache.make_key(messagelist, settings)
+        if use_cache:
+            try:
+                content = self.cache.get(key)
+                if content is not None: return key, { "role": "assistant", "content": content }
+            except Exception as e: logging.warning(f"{func_name()}: 读取响应缓存失败：{e}")
+        return key, {}
+
+    def _finish(self, completion, key: str|None, settings: dict) -> dict:
+        """整理回复内容并写入缓存。要求JSON输出却解析不了时抛出ResponseParseError，交给重试策略处理"""
         content = completion.choices[0].message.content
         if type(content) == str: content = content.strip("`").strip("json").strip()
         if type(content) == bytes: content = content.decode('utf-8')
         if type(content) == dict: content = json.dumps(content, ensure_ascii=False)
         logging.debug(f"{completion.choices[0].message.content}")
+        if settings.get("response_format", {}).get("type") == "json_object":
+            try: json.loads(content)
+            except Exception as e: raise ResponseParseError(f"回复不是合法JSON：{e}")
+        if key is not None and isinstance(content, str):
+            try: self.cache.put(key, content)
+            except Exception as e: logging.warning(f"{func_name()}: 写入响应缓存失败：{e}")
         return { "role": "assistant", "content": content }
+
+    def _account(self, completion, settings: dict, estimated: int, stage: str) -> None:
+        """用回复中的usage修正TPM令牌桶并记账，服务端没给usage时按预估值处理"""
+        usage = getattr(completion, "usage", None)
+        prompt_tokens = getattr(usage, "prompt_tokens", None) or estimated
+        completion_tokens = getattr(usage, "completion_tokens", None) or 0
+        rate_limiter.settle(settings, estimated, prompt_tokens + completion_tokens)
+        self.usage.add(self.current_file, stage, prompt_tokens, completion_tokens)
+
+    def usage_summary(self, file: str|None=None, by: str="stage") -> dict[str, dict[str, int]]:
+        """token用量汇总，参数见UsageMeter.summary"""
+        return self.usage.summary(file, by)
+
+    def cache_stats(self) -> dict:
+        """响应缓存的命中/未命中次数与条目数，未启用缓存时返回空字典"""
+        if self.cache is None: return {}
+        return self.cache.stats()
+
+    def _create(self, messagelist: list[dict], settings: dict):
+        """实际发起请求。支持response_format的端点优先带上它，失败则退回普通请求"""
+        client = get_client(settings, self.client_settings)
+        if settings.get("response_format", False):
+            try:
+                return client.chat.completions.create(
+                    model=settings["model"],
+                    messages=messagelist,
+                    temperature=settings.get("temperature", 1.0),
+                    response_format=settings["response_format"]
+                )
+            except (openai.BadRequestError, openai.UnprocessableEntityError) as e:
+                # 只有端点不支持response_format时才退回，限流、超时等错误交给重试策略
+                logging.debug(f"{func_name()}: 带response_format请求失败，退回普通请求：{e}")
+        return client.chat.completions.create(
+            model=settings["model"],
+            messages=messagelist,
+            temperature=settings.get("temperature", 1.0)
+        )
+
+    async def _acreate_limited(self, messagelist: list[dict], settings: dict):
+        async with self._async_slot(settings): return await self._acreate(messagelist, settings)
+
+    async def _acreate(self, messagelist: list[dict], settings: dict):
+        """_create的协程版本"""
+        client = self._async_client(settings)
+        if settings.get("response_format", False):
+            try:
+                return await client.chat.completions.create(
+                    model=settings["model"],
+                    messages=messagelist,
+                    temperature=settings.get("temperature", 1.0),
+                    response_format=settings["response_format"]
+                )
+            except (openai.BadRequestError, openai.UnprocessableEntityError) as e:
+                # 只有端点不支持response_format时才退回，限流、超时等错误交给重试策略
+                logging.debug(f"{func_name()}: 带response_format请求失败，退回普通请求：{e}")
+        return await client.chat.completions.create(
+            model=settings["model"],
+            messages=messagelist,
+            temperature=settings.get("temperature", 1.0)
+        )
+
+    # 异步客户端和信号量都绑定在创建它们的事件循环上，所以按循环分别保存
+
+    def _async_state(self) -> dict:
+        loop = asyncio.get_running_loop()
+        state = self._async_states.get(loop)
+        if state is None:
+            state = { "clients": {}, "slots": {} }
+            self._async_states[loop] = state
+        return state
+
+    def _async_client(self, settings: dict) -> openai.AsyncOpenAI:
+        clients = self._async_state()["clients"]
+        key = (settings.get("api_base", ""), settings.get("api_key", ""))
+        if key not in clients:
+            cs = self.client_settings
+            http_client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=cs.get("max_connections", 32),
+                    max_keepalive_connections=cs.get("max_keepalive_connections", 16),
+                    keepalive_expiry=cs.get("keepalive_expiry", 60)
+                ),
+                timeout=httpx.Timeout(cs.get("timeout", 120), connect=cs.get("connect_timeout", 10))
+            )
+            clients[key] = openai.AsyncOpenAI(api_key=key[1], base_url=key[0], http_client=http_client, max_retries=0)
+        return clients[key]
+
+    def _async_slot(self, settings: dict) -> asyncio.Semaphore:
+        slots = self._async_state()["slots"]
+        key = settings.get("api_base", "")
+        if key not in slots: slots[key] = asyncio.Semaphore(max(1, int(settings.get("max_concurrency", 4))))
+        return slots[key]
+
+    async def aclose(self) -> None:
+        """关闭当前事件循环上的异步客户端，应在asyncio.run结束前调用"""
+        state = self._async_states.pop(asyncio.get_running_loop(), None)
+        if not state: return
+        for client in state["clients"].values():
+            try: await client.close()
+            except Exception as e: logging.debug(f"{func_name()}: {e}")
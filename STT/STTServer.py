@@ -1,14 +1,102 @@
+import collections
+import gc
+import hashlib
 import json
 import logging
+import multiprocessing
 import queue
 import shutil
-import sys, os, uuid
+import subprocess
+import threading
+import sys, os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from lib_helper import load_json_with_comments, func_name
 
 # 这个库只负责把音频转换为json格式的字幕，存放在指定路径下。
 
 DONE = "#DONE"
+SAMPLE_RATE = 16000
+
+
+class ModelRegistry:
+    def __init__(self, max_models: int=1, min_free_memory_gb: float=0):
+        """进程级的STT模型缓存，键为(engine, size, device)，在多次Framework运行之间保留
+        \n超过max_models个，或目标设备剩余内存低于min_free_memory_gb时，按最近最少使用的顺序卸载"""
+        self.max_models = max_models
+        self.min_free_memory_gb = min_free_memory_gb
+        self._models = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple[str, str, str], loader):
+        """取得key对应的模型，没有就调用loader()加载。加载时持有锁，同一模型不会被重复加载"""
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key]
+            while self._models and (len(self._models) >= self.max_models or self._memory_tight(key[2])):
+                self._evict(next(iter(self._models)))
+            logging.info(f"{func_name()}: 加载STT模型 {key}")
+            model = loader()
+            self._models[key] = model
+            return model
+
+    def unload(self, key: tuple[str, str, str]|None=None) -> None:
+        """卸载指定模型，key为None时卸载全部"""
+        with self._lock:
+            for k in ([key] if key is not None else list(self._models)):
+                if k in self._models: self._evict(k)
+
+    def loaded(self) -> list[tuple[str, str, str]]:
+        with self._lock: return list(self._models)
+
+    def _evict(self, key) -> None:
+        """调用方需持有锁"""
+        del self._models[key]
+        gc.collect()
+        if key[2].startswith("cuda"):
+            try:
+                import torch
+                torch.cuda.empty_cache()
+            except Exception: pass
+        logging.info(f"{func_name()}: 已卸载STT模型 {key}")
+
+    def _memory_tight(self, device: str) -> bool:
+        if not self.min_free_memory_gb: return False
+        try:
+            if device.startswith("cuda"):
+                import torch
+                free = torch.cuda.mem_get_info(torch.device(device))[0]
+            else:
+                free = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+        except Exception: return False
+        return free < self.min_free_memory_gb * 1024 ** 3
+
+# 整个进程共用，UI里每次点击“运行”新建的STTServer都从这里拿模型
+registry = ModelRegistry()
+
+
+class SegmentStream:
+    def __init__(self, name: str):
+        """流式转录时代替字幕路径压入处理队列的对象。STT一边转录一边put句段，使用方一边迭代一边翻译
+        \n转录结束后close，result_path为完整json的路径，失败则为None"""
+        self.name = name
+        self.result_path = None
+        self._queue = queue.Queue()
+
+    def put(self, segments: list[dict]) -> None:
+        if segments: self._queue.put(segments)
+
+    def close(self, result_path: str|None) -> None:
+        self.result_path = result_path
+        self._queue.put(None)
+
+    def __iter__(self):
+        """依次产出每批新转录好的句段（主格式的segments），直到close"""
+        while True:
+            segments = self._queue.get()
+            if segments is None: return
+            yield segments
 
 class STTServer:
     def __init__(self, initial_prompt: str|None=None): 
@@ -20,67 +108,502 @@ class STTServer:
         os.makedirs(self.output_dir, exist_ok=True)
         self.settings = self.settings['engine_settings']
         self.initial_prompt = initial_prompt if initial_prompt and self.settings["use_initial_prompt"] else None
-        
-        self.stable_whisper_init()
+        self.model = None
+        self.model_key = None
+        self._split_executor = None
+        self.transcripts = TranscriptCache.from_settings(self.settings, self.initial_prompt) if self.settings.get("transcript_cache", {}).get("enable", False) else None
+
+        # 多进程转录、切分长音频时模型由各工作进程自己加载，主进程不必占一份；启用转录缓存时等确认有文件要转录再加载
+        if self.workers() <= 1 and self.transcripts is None and not self.split_mode(): self.stable_whisper_init()
+
+    def split_mode(self) -> bool:
+        """是否切分长音频。单进程处理时无论长短都交给切分进程池，主进程不加载模型；多进程并行时只有长音频走切分"""
+        return self.settings.get("split_long_audio", False) and not self.settings.get("streaming", False)
+
+    def workers(self) -> int:
+        if self.settings.get("streaming", False): return 1
+        return max(1, int(self.settings.get("stt_workers", 1)))
 
     def stt(self, processing_queue: queue.Queue=None) -> None:
         """把输入目录下的所有可处理的文件打成字幕，字幕文件的路径压入堆"""
         all_items = os.listdir(self.input_dir)
         files_only = sorted([os.path.join(self.input_dir, item) for item in all_items if os.path.isfile(os.path.join(self.input_dir, item))])
+        files = [filename for filename in files_only if any(filename.endswith(ext) for ext in self.exts)]
 
-        for filename in files_only: 
-            for ext in self.exts:
-                if filename.endswith(ext): 
-                    self.stable_whisper_stt(filename, processing_queue)
-                    break
-        self.model = None # 释放
+        if self.transcripts is not None: # 命中的直接压入，不必等模型
+            pending = []
+            for filename in files:
+                result_path = self.transcripts.fetch(filename, self.output_dir)
+                if result_path is None: pending.append(filename)
+                elif processing_queue != None: processing_queue.put(result_path)
+            files = pending
+
+        if not files: pass
+        elif self.workers() > 1 and len(files) > 1:
+            # 多进程按文件并行时，长音频仍要切分，否则转录结果与缓存键里的切分设置对不上。先并行转录其余文件，再逐个切分长音频
+            long_files = [filename for filename in files if self.long_audio(filename)] if self.split_mode() else []
+            rest = [filename for filename in files if filename not in long_files]
+            if long_files: logging.info(f"{func_name()}: {len(long_files)} 个长音频在其余文件并行转录完后切分转录")
+            if rest: self.stt_parallel(rest, processing_queue)
+            for filename in long_files: self.stable_whisper_stt_split(filename, processing_queue)
+        else:
+            if self.model is None and not self.split_mode(): self.stable_whisper_init()
+            for filename in files: 
+                if self.settings.get("streaming", False) and processing_queue != None: self.stable_whisper_stt_stream(filename, processing_queue)
+                elif self.settings.get("split_long_audio", False): self.stable_whisper_stt_split(filename, processing_queue)
+                else: self.stable_whisper_stt(filename, processing_queue)
+            self.model = None
+            if not self.settings.get("keep_model_loaded", True): registry.unload(self.model_key) # 释放
+        if self._split_executor is not None:
+            self._split_executor.shutdown()
+            self._split_executor = None
 
         if processing_queue != None: processing_queue.put(DONE) # 运行完毕信号
 
+    def stt_parallel(self, files: list[str], processing_queue: queue.Queue=None) -> None:
+        """用stt_workers个进程同时转录多个文件，每个进程各自持有一份模型
+        \nordered_output为True时严格按文件名顺序压入结果，否则谁先转录完先压入谁"""
+        workers = min(self.workers(), len(files))
+        threads = self.settings.get("threads_per_worker", 0) or max(1, (os.cpu_count() or 1) // workers)
+        logging.info(f"{func_name()}: 使用 {workers} 个进程转录 {len(files)} 个文件，每进程 {threads} 线程")
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"), # CUDA不支持fork出来的子进程
+            initializer=_init_worker,
+            initargs=(threads,)
+        ) as executor:
+            futures = [executor.submit(_worker_stt, filename, self.output_dir, self.settings, self.initial_prompt) for filename in files]
+            done = futures if self.settings.get("ordered_output", True) else as_completed(futures)
+            for future in done:
+                try: result_path = future.result()
+                except Exception as e:
+                    logging.warning(f"{func_name()}: 转录进程出错：{e}")
+                    continue
+                if result_path and self.transcripts is not None: self.transcripts.store(files[futures.index(future)], result_path)
+                if result_path and processing_queue != None: processing_queue.put(result_path)
+
     def stable_whisper_init(self) -> None:
-        import stable_whisper
-        self.model = stable_whisper.load_model(self.settings.get('model', 'medium'))
+        self.model_key, self.model = load_stable_whisper(self.settings)
             
     def stable_whisper_stt(self, audio_path: str, processing_queue: queue.Queue=None) -> bool: # 待完成
+        result_path = transcribe_to_json(self.model, audio_path, self.output_dir, self.settings, self.initial_prompt)
+        if result_path is None: return False
+        if self.transcripts is not None: self.transcripts.store(audio_path, result_path)
+        if processing_queue != None: processing_queue.put(result_path)
+        return True
+    def split_executor(self) -> ProcessPoolExecutor:
+        """切分转录用的进程池，第一次用时创建，stt结束时关闭。每个进程各持有一份模型"""
+        if self._split_executor is None:
+            workers = max(1, int(self.settings.get("split_workers", 2)))
+            threads = self.settings.get("threads_per_worker", 0) or max(1, (os.cpu_count() or 1) // workers)
+            self._split_executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(threads,)
+            )
+        return self._split_executor
+
+    def stable_whisper_stt_split(self, audio_path: str, processing_queue: queue.Queue=None) -> bool:
+        """长音频转录：先按静音把音频切成约split_target秒的若干段，再用split_workers个进程并行转录各段
+        \n各段只解码自己那一截，拼回时平移时间戳并重新编号。短于split_min_duration秒的交给进程池里的一个进程整段转录
+        \n先用ffprobe读时长，只有确实要切的文件才解码整段算响度"""
         if not os.path.exists(audio_path): 
             logging.warning(f"{func_name()}: 文件 \"{audio_path}\" 不存在")
             return False
-        id = str(uuid.uuid4())
-        file_extension = os.path.splitext(audio_path)[1]
-        temp_audio_path = os.path.join(self.output_dir, f"{id}{file_extension}")
+        try:
+            min_duration = self.settings.get("split_min_duration", 1800)
+            duration = media_duration(os.path.normpath(audio_path))
+            energy = None
+            if duration is None: # 读不到时长（没有ffprobe或容器里没写），只能解码一遍
+                energy = self.energy(audio_path)
+                duration = len(energy) * ENERGY_FRAME
+            if duration < min_duration:
+                result_path = self.split_executor().submit(_worker_stt, os.path.normpath(audio_path), self.output_dir, self.settings, self.initial_prompt).result()
+                if result_path is None: return False
+                if self.transcripts is not None: self.transcripts.store(audio_path, result_path)
+                if processing_queue != None: processing_queue.put(result_path)
+                return True
+            if energy is None: energy = self.energy(audio_path)
 
-        try: # whisper没法支持奇怪字符的文件名，你说这扯不扯
-            shutil.copy2(os.path.normpath(audio_path), temp_audio_path)
-            no_speech_threshold = self.settings.get('no_speech_threshold', 0.6)
-            result = self.model.transcribe(
-                os.path.normpath(audio_path), 
-                no_speech_threshold=no_speech_threshold,
-                initial_prompt=self.initial_prompt
-            ).to_dict()
-            newsegments = []
-            i = 0
-            for segment in result["segments"]:
-                segment["id"] = i
-                newsegments.append(segment)
-                i += 1
-            result["segments"] = newsegments
+            pieces = find_split_points(
+                energy,
+                self.settings.get("split_target", 600),
+                self.settings.get("split_min_silence", 0.5),
+                self.settings.get("silence_threshold_db", -40)
+            )
+            logging.info(f"{func_name()}: {audio_path} 时长 {duration:.0f} 秒，切成 {len(pieces)} 段并行转录")
+            futures = [
+                self.split_executor().submit(_worker_stt_piece, os.path.normpath(audio_path), start, end - start, self.settings, self.initial_prompt)
+                for start, end in pieces
+            ]
+
+            result = None
+            segments = []
+            for (start, _), future in zip(pieces, futures):
+                piece = future.result()
+                if result is None: result = piece
+                offset_segments(piece["segments"], start, len(segments))
+                segments += piece["segments"]
+            result["segments"] = segments
+            result["text"] = "".join(segment.get("text", "") for segment in segments)
 
             result_path = os.path.join(self.output_dir, os.path.basename(os.path.normpath(audio_path))+".json")
             with open(result_path, "w+", encoding="utf-8") as f: json.dump(result, f, ensure_ascii=False, indent=3)
-
-            try: 
-                if os.path.exists(temp_audio_path): os.remove(temp_audio_path)
-                logging.info(f"{func_name()}: 临时文件删除成功")
-            except: logging.info(f"{func_name()}: 临时文件删除失败")
             logging.info(f"{func_name()}: STT完毕：{audio_path}")
+            if self.transcripts is not None: self.transcripts.store(audio_path, result_path)
             if processing_queue != None: processing_queue.put(result_path)
             return True
-        
+
         except Exception as e:
             logging.warning(f"{func_name()}: 发送错误：{e}")
-            if os.path.exists(temp_audio_path): os.remove(temp_audio_path)
             return False
 
+    def long_audio(self, audio_path: str) -> bool:
+        """时长不短于split_min_duration。读不到时长的也算，交给stable_whisper_stt_split解码后再判断"""
+        duration = media_duration(os.path.normpath(audio_path))
+        return duration is None or duration >= self.settings.get("split_min_duration", 1800)
+
+    def energy(self, audio_path: str):
+        if self.settings.get("audio_cache", {}).get("enable", False): return samples_energy(get_audio(os.path.normpath(audio_path), self.settings))
+        return frame_energy(os.path.normpath(audio_path))
+
+    def stable_whisper_stt_stream(self, audio_path: str, processing_queue: queue.Queue) -> bool:
+        """流式转录：按stream_window秒的窗口逐段转录，每转录完一个窗口就把新句段推给SegmentStream
+        \n窗口末尾的最后一句可能被截断，所以除最后一个窗口外都丢掉它，下一个窗口从它的开头继续"""
+        if not os.path.exists(audio_path): 
+            logging.warning(f"{func_name()}: 文件 \"{audio_path}\" 不存在")
+            return False
+        stream = SegmentStream(os.path.basename(os.path.normpath(audio_path)))
+        processing_queue.put(stream)
+
+        try:
+            audio = get_audio(os.path.normpath(audio_path), self.settings)
+            window = int(self.settings.get("stream_window", 300) * SAMPLE_RATE)
+            no_speech_threshold = self.settings.get('no_speech_threshold', 0.6)
+            result = None
+            segments = []
+            start = 0
+            while start < len(audio):
+                end = min(start + window, len(audio))
+                piece = self.model.transcribe(
+                    audio[start:end],
+                    no_speech_threshold=no_speech_threshold,
+                    initial_prompt=self.initial_prompt
+                ).to_dict()
+                if result is None: result = piece
+                new_segments = piece["segments"]
+                next_start = end
+                if end < len(audio) and len(new_segments) > 1:
+                    cut = start + int(new_segments[-1]["start"] * SAMPLE_RATE)
+                    if cut > start:
+                        next_start = cut
+                        new_segments = new_segments[:-1]
+                offset_segments(new_segments, start / SAMPLE_RATE, len(segments))
+                segments += new_segments
+                stream.put(new_segments)
+                logging.info(f"{func_name()}: {stream.name} 已转录至 {next_start / SAMPLE_RATE:.0f} 秒")
+                start = next_start
+
+            result = result or { "text": "" }
+            result["segments"] = segments
+            result["text"] = "".join(segment.get("text", "") for segment in segments)
+            result_path = os.path.join(self.output_dir, stream.name+".json")
+            with open(result_path, "w+", encoding="utf-8") as f: json.dump(result, f, ensure_ascii=False, indent=3)
+            logging.info(f"{func_name()}: STT完毕：{audio_path}")
+            if self.transcripts is not None: self.transcripts.store(audio_path, result_path)
+            stream.close(result_path)
+            return True
+
+        except Exception as e:
+            logging.warning(f"{func_name()}: 发送错误：{e}")
+            stream.close(None)
+            return False
+
+def load_stable_whisper(settings: dict):
+    """从registry取得engine_settings对应的stable_whisper模型，返回(key, model)"""
+    import stable_whisper, torch
+    size = settings.get('model', 'medium')
+    device = settings.get('device', '') or ("cuda" if torch.cuda.is_available() else "cpu")
+    registry.max_models = settings.get('max_loaded_models', 1)
+    registry.min_free_memory_gb = settings.get('min_free_memory_gb', 0)
+    key = ("stable_whisper", size, device)
+    return key, registry.get(key, lambda: stable_whisper.load_model(size, device=device))
+
+def transcribe_to_json(model, audio_path: str, output_dir: str, settings: dict, initial_prompt: str|None=None) -> str|None:
+    """转录一个文件，主格式json写到output_dir，返回其路径，失败返回None"""
+    if not os.path.exists(audio_path): 
+        logging.warning(f"{func_name()}: 文件 \"{audio_path}\" 不存在")
+        return None
+
+    try: # 不再把源文件复制一份：ffmpeg直接从原路径只解码音轨，经管道交给模型，文件名里的奇怪字符也不受影响
+        no_speech_threshold = settings.get('no_speech_threshold', 0.6)
+        result = model.transcribe(
+            get_audio(os.path.normpath(audio_path), settings), 
+            no_speech_threshold=no_speech_threshold,
+            initial_prompt=initial_prompt
+        ).to_dict()
+        newsegments = []
+        i = 0
+        for segment in result["segments"]:
+            segment["id"] = i
+            newsegments.append(segment)
+            i += 1
+        result["segments"] = newsegments
+
+        result_path = os.path.join(output_dir, os.path.basename(os.path.normpath(audio_path))+".json")
+        with open(result_path, "w+", encoding="utf-8") as f: json.dump(result, f, ensure_ascii=False, indent=3)
+        logging.info(f"{func_name()}: STT完毕：{audio_path}")
+        return result_path
+    
+    except Exception as e:
+        logging.warning(f"{func_name()}: 发送错误：{e}")
+        return None
+
+ENERGY_FRAME = 0.03 # 秒，静音检测的帧长
+
+def ffmpeg_pcm_command(audio_path: str, start: float=0, duration: float|None=None) -> list[str]:
+    """ffmpeg只解码音轨，输出16kHz单声道s16le到stdout。参数以列表传入，文件名里有什么字符都无所谓"""
+    command = ["ffmpeg", "-nostdin", "-threads", "0"]
+    if start: command += ["-ss", str(start)]
+    command += ["-i", audio_path]
+    if duration is not None: command += ["-t", str(duration)]
+    command += ["-vn", "-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le", "-ar", str(SAMPLE_RATE), "-loglevel", "error", "-"]
+    return command
+
+def media_duration(audio_path: str) -> float|None:
+    """用ffprobe从容器元数据读时长（秒），不解码。读不到返回None"""
+    command = ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1", audio_path]
+    try: return float(subprocess.run(command, capture_output=True, check=True, text=True).stdout.strip())
+    except (OSError, ValueError, subprocess.CalledProcessError): return None
+
+def load_audio(audio_path: str, start: float=0, duration: float|None=None):
+    """解码audio_path从start秒开始、长duration秒（None为到结尾）的音频，返回float32的numpy数组"""
+    import numpy as np
+    out = subprocess.run(ffmpeg_pcm_command(audio_path, start, duration), capture_output=True, check=True).stdout
+    return np.frombuffer(out, np.int16).flatten().astype(np.float32) / 32768.0
+
+def _block_energy(samples):
+    """samples长度须是整帧，返回每帧的响度（dBFS）"""
+    import numpy as np
+    frames = samples.reshape(-1, int(ENERGY_FRAME * SAMPLE_RATE))
+    return 10 * np.log10(np.mean(frames ** 2, axis=1) + 1e-10)
+
+def frame_energy(audio_path: str):
+    """流式解码整段音频，返回每ENERGY_FRAME秒一帧的响度（dBFS）。只保留每帧一个数，内存占用与音频长度无关"""
+    import numpy as np
+    frame = int(ENERGY_FRAME * SAMPLE_RATE)
+    block = frame * 2 * 2000 # 每次读2000帧，s16le每个采样2字节
+    energies = []
+    rest = b""
+    with subprocess.Popen(ffmpeg_pcm_command(audio_path), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL) as process:
+        while True:
+            data = process.stdout.read(block)
+            if not data: break
+            data = rest + data
+            usable = len(data) // (frame * 2) * (frame * 2)
+            rest = data[usable:]
+            energies.append(_block_energy(np.frombuffer(data[:usable], np.int16).astype(np.float32) / 32768.0))
+    if process.returncode: raise RuntimeError(f"ffmpeg解码失败：{audio_path}")
+    return np.concatenate(energies) if energies else np.zeros(0, np.float32)
+
+def samples_energy(audio):
+    """与frame_energy相同，但输入是已解码的数组（例如缓存里内存映射出来的），分块计算避免整段复制"""
+    import numpy as np
+    frame = int(ENERGY_FRAME * SAMPLE_RATE)
+    usable = len(audio) // frame * frame
+    step = frame * 2000
+    energies = [_block_energy(np.asarray(audio[i:min(i + step, usable)])) for i in range(0, usable, step)]
+    return np.concatenate(energies) if energies else np.zeros(0, np.float32)
+
+# 已算过的哈希，键为(绝对路径, 大小, 修改时间, full)。转录缓存查一次、存一次，音频缓存再查一次，全文件哈希只读一遍
+_media_hashes = collections.OrderedDict()
+_media_hashes_lock = threading.Lock()
+
+def media_hash(path: str, full: bool=False) -> str:
+    """音视频文件的内容哈希。full为True时读全文件
+    \n为False时只读文件大小、修改时间和开头、中间、结尾各8MB，几GB的视频也是毫秒级。重新剪辑/编码后大小和抽样块碰巧不变的文件靠修改时间区分
+    \n同一进程里文件没变（大小和修改时间相同）时直接返回上次的结果"""
+    stat = os.stat(path)
+    size = stat.st_size
+    memo_key = (os.path.abspath(path), size, stat.st_mtime_ns, full)
+    with _media_hashes_lock:
+        if memo_key in _media_hashes:
+            _media_hashes.move_to_end(memo_key)
+            return _media_hashes[memo_key]
+    block = 8 * 1024 * 1024
+    sampled = not full and size > block * 3
+    h = hashlib.blake2b(f"{size}|{stat.st_mtime_ns}".encode() if sampled else str(size).encode(), digest_size=20)
+    with open(path, "rb") as f:
+        if not sampled:
+            while data := f.read(block): h.update(data)
+        else:
+            for offset in (0, size // 2 - block // 2, size - block):
+                f.seek(offset)
+                h.update(f.read(block))
+    with _media_hashes_lock:
+        _media_hashes[memo_key] = h.hexdigest()
+        while len(_media_hashes) > 1024: _media_hashes.popitem(last=False)
+    return h.hexdigest()
+
+class AudioCache:
+    def __init__(self, cache_dir: str="STT/cache/audio", max_gb: float=20, full_hash: bool=False):
+        """解码后音频的磁盘缓存，存为.npy，读取时内存映射。键为文件内容哈希加解码参数
+        \n总大小超过max_gb时按最近最少使用的顺序删除"""
+        self.cache_dir = os.path.normpath(cache_dir)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.max_bytes = max_gb * 1024 ** 3
+        self.full_hash = full_hash
+
+    @classmethod
+    def from_settings(cls, settings: dict) -> "AudioCache":
+        cache_settings = settings.get("audio_cache", {})
+        return cls(cache_settings.get("dir", "STT/cache/audio"), cache_settings.get("max_gb", 20), cache_settings.get("full_hash", False))
+
+    def path_for(self, audio_path: str) -> str:
+        key = hashlib.blake2b(f"{media_hash(audio_path, self.full_hash)}|{SAMPLE_RATE}|mono|float32".encode(), digest_size=20).hexdigest()
+        return os.path.join(self.cache_dir, key+".npy")
+
+    def load(self, audio_path: str):
+        """返回整段音频的数组。命中时直接内存映射（写时复制，模型改动数组也不会写回文件），未命中时解码并写入缓存"""
+        import numpy as np
+        path = self.path_for(audio_path)
+        if os.path.exists(path):
+            os.utime(path) # 用修改时间记录最近使用
+            logging.info(f"{func_name()}: 音频缓存命中：{audio_path}")
+        else:
+            audio = load_audio(audio_path)
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, "wb") as f: np.save(f, audio)
+            os.replace(temp_path, path)
+            self.evict()
+        return np.load(path, mmap_mode="c")
+
+    def evict(self) -> None:
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".npy"): continue
+            stat = os.stat(os.path.join(self.cache_dir, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes: break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+                total -= size
+                logging.info(f"{func_name()}: 淘汰音频缓存 {name}")
+            except OSError as e: logging.warning(f"{func_name()}: 删除音频缓存失败：{e}")
+
+class TranscriptCache:
+    # 会改变转录结果的engine_settings项，和模型、initial_prompt一起进缓存键
+    KEY_SETTINGS = ["model", "no_speech_threshold", "split_long_audio", "split_min_duration", "split_target", "split_min_silence", "silence_threshold_db", "streaming", "stream_window"]
+
+    def __init__(self, settings: dict, initial_prompt: str|None=None, cache_dir: str="STT/cache/transcripts", max_entries: int=1000, full_hash: bool=True):
+        """转录结果的持久缓存，键为媒体内容哈希加STT模型和相关设置。与output_dir分开存放，delete_stt删不到它
+        \n条目超过max_entries时按最近最少使用的顺序删除"""
+        self.cache_dir = os.path.normpath(cache_dir)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.max_entries = max_entries
+        self.full_hash = full_hash
+        self.fingerprint = json.dumps([{k: settings.get(k) for k in self.KEY_SETTINGS}, initial_prompt], ensure_ascii=False, sort_keys=True)
+
+    @classmethod
+    def from_settings(cls, settings: dict, initial_prompt: str|None=None) -> "TranscriptCache":
+        cache_settings = settings.get("transcript_cache", {})
+        # 命中就整个跳过STT，认错文件的代价比多读一遍文件大得多，所以默认读全文件算哈希，抽样要显式关掉full_hash
+        return cls(settings, initial_prompt, cache_settings.get("dir", "STT/cache/transcripts"), cache_settings.get("max_entries", 1000), cache_settings.get("full_hash", True))
+
+    def path_for(self, audio_path: str) -> str:
+        key = hashlib.blake2b(f"{media_hash(audio_path, self.full_hash)}|{self.fingerprint}".encode(), digest_size=20).hexdigest()
+        return os.path.join(self.cache_dir, key+".json")
+
+    def fetch(self, audio_path: str, output_dir: str) -> str|None:
+        """命中时把缓存的json复制到output_dir（与正常转录同名），返回其路径；未命中返回None"""
+        try:
+            path = self.path_for(audio_path)
+            if not os.path.exists(path): return None
+            result_path = os.path.join(output_dir, os.path.basename(os.path.normpath(audio_path))+".json")
+            shutil.copyfile(path, result_path)
+            os.utime(path)
+            logging.info(f"{func_name()}: 转录缓存命中，跳过STT：{audio_path}")
+            return result_path
+        except OSError as e:
+            logging.warning(f"{func_name()}: 读取转录缓存失败：{e}")
+            return None
+
+    def store(self, audio_path: str, result_path: str) -> None:
+        try:
+            path = self.path_for(audio_path)
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            shutil.copyfile(result_path, temp_path)
+            os.replace(temp_path, path)
+            self.evict()
+        except OSError as e: logging.warning(f"{func_name()}: 写入转录缓存失败：{e}")
+
+    def evict(self) -> None:
+        entries = sorted((os.stat(os.path.join(self.cache_dir, name)).st_mtime, name) for name in os.listdir(self.cache_dir) if name.endswith(".json"))
+        for _, name in entries[:max(0, len(entries) - self.max_entries)]:
+            try: os.remove(os.path.join(self.cache_dir, name))
+            except OSError: pass
+
+def get_audio(audio_path: str, settings: dict, start: float=0, duration: float|None=None):
+    """按engine_settings取音频：启用audio_cache时从缓存内存映射后切片，否则直接用ffmpeg解码所需的那一截"""
+    if not settings.get("audio_cache", {}).get("enable", False): return load_audio(audio_path, start, duration)
+    audio = AudioCache.from_settings(settings).load(audio_path)
+    begin = int(start * SAMPLE_RATE)
+    return audio[begin:] if duration is None else audio[begin:begin + int(duration * SAMPLE_RATE)]
+
+def find_split_points(energy, target: float, min_silence: float, threshold_db: float) -> list[tuple[float, float]]:
+    """根据帧响度把音频切成若干(start, end)段（秒）。每段尽量在target秒附近的静音中点处切开，
+    \n在[0.5, 1.5]倍target内找不到至少min_silence秒的静音时，就在target处硬切"""
+    import numpy as np
+    total = len(energy) * ENERGY_FRAME
+    silent = np.concatenate([[False], energy < threshold_db, [False]])
+    edges = np.flatnonzero(silent[1:] != silent[:-1]) # 静音段的起止帧交替出现
+    starts, ends = edges[0::2], edges[1::2]
+    long_enough = (ends - starts) * ENERGY_FRAME >= min_silence
+    candidates = (starts[long_enough] + ends[long_enough]) / 2 * ENERGY_FRAME
+
+    pieces = []
+    position = 0.0
+    while total - position > target * 1.5:
+        goal = position + target
+        window = candidates[(candidates > position + target * 0.5) & (candidates < position + target * 1.5)]
+        cut = float(window[np.argmin(np.abs(window - goal))]) if len(window) else goal
+        pieces.append((position, cut))
+        position = cut
+    pieces.append((position, total))
+    return pieces
+
+def _init_worker(threads: int) -> None:
+    """转录子进程的初始化：限制每个进程的计算线程数，避免多个进程互相抢核"""
+    for name in ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"]: os.environ[name] = str(threads)
+    import torch
+    torch.set_num_threads(threads)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+def _worker_stt(audio_path: str, output_dir: str, settings: dict, initial_prompt: str|None) -> str|None:
+    """在子进程里转录，模型放在子进程自己的registry里，同一进程处理下一个文件时直接复用"""
+    _, model = load_stable_whisper(settings)
+    return transcribe_to_json(model, audio_path, output_dir, settings, initial_prompt)
+
+def _worker_stt_piece(audio_path: str, start: float, duration: float, settings: dict, initial_prompt: str|None) -> dict:
+    """在子进程里转录音频的一截，返回该截的转录结果（时间戳从0算起）"""
+    _, model = load_stable_whisper(settings)
+    return model.transcribe(
+        get_audio(audio_path, settings, start, duration),
+        no_speech_threshold=settings.get('no_speech_threshold', 0.6),
+        initial_prompt=initial_prompt
+    ).to_dict()
+
+def offset_segments(segments: list[dict], offset: float, first_id: int) -> None:
+    """把从某个时间点开始转录的句段平移到全局时间轴上，并从first_id开始重新编号（原地修改）"""
+    for i, segment in enumerate(segments):
+        segment["id"] = first_id + i
+        for item in [segment] + segment.get("words", []):
+            if "start" in item: item["start"] += offset
+            if "end" in item: item["end"] += offset
+
 if __name__ == "__main__":
     logging.basicConfig(
         level=logging.INFO,
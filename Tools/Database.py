@@ -11,12 +11,42 @@ SCHAR = {
     " ": ["。", "，", ".", ",", "？", "?", "！", "!", "；", ";", "：", ":", "“", "”", "\"", "‘", "’", "'", "（", "）", "(", ")", "《", "》", "[", "]", "【", "】", "…", "*", "-", "/"]
 }
 
+# WAL下读写互不阻塞；synchronous=NORMAL在WAL下只在检查点时刷盘，断电最多丢最后几个事务，不会损坏
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -65536, # 负数单位是KB，即64MB
+    "mmap_size": 268435456,
+    "temp_store": "MEMORY"
+}
+
+# 表结构版本，存在PRAGMA user_version里。低于它的库在启动时升级一次
+SCHEMA_VERSION = 1
+
+def trigram_supported() -> bool:
+    """trigram分词器要SQLite 3.34以上"""
+    try:
+        sqlite3.connect(":memory:").execute("CREATE VIRTUAL TABLE t USING fts5(a, tokenize='trigram')")
+        return True
+    except sqlite3.OperationalError: return False
+
 class DB:
-    def __init__(self, db_path="Tools/Database.db", clean=True):
+    def __init__(self, db_path="Tools/Database.db", clean=True, tokenizer="trigram", weights=(2.0, 1.0), namespace=""):
+        """写入走self.conn，由_conn_lock保护；查询走每个线程自己的只读连接，不和写入抢锁
+        \n tokenizer为trigram时中日文按三字切分，任意位置的子串都能走索引；unicode61会把一串汉字/假名当成一个词
+        \n weights是bm25给(original_text, translated_text)的权重，默认原文命中优先
+        \n namespace用来在一个持久库里区分不同系列/项目，存、查、清空都只涉及当前namespace"""
         self.db_path = db_path
+        self.namespace = namespace
+        if tokenizer == "trigram" and not trigram_supported():
+            logging.warning(f"SQLite {sqlite3.sqlite_version} 不支持trigram分词，改用unicode61")
+            tokenizer = "unicode61"
+        self.tokenizer = tokenizer
+        self.weights = tuple(weights)
         os.makedirs(os.path.dirname(db_path) if os.path.dirname(db_path) else '.', exist_ok=True)
         # lock to protect sqlite connection when used across threads
         self._conn_lock = threading.Lock()
+        self._local = threading.local()
         self.setup()
         if clean: 
             self.clear()
@@ -27,52 +57,28 @@ class DB:
             # persistent connection to allow access from other threads; protect with lock
             self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
             cursor = self.conn.cursor()
+            for name, value in PRAGMAS.items(): cursor.execute(f"PRAGMA {name}={value}")
 
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS translation_history (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     original_text TEXT NOT NULL,
                     translated_text TEXT NOT NULL,
-                    created_time DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            cursor.execute("DROP TABLE IF EXISTS translation_fts")
-            cursor.execute("DROP TRIGGER IF EXISTS translation_fts_ai")
-            cursor.execute("DROP TRIGGER IF EXISTS translation_fts_ad")
-            cursor.execute("DROP TRIGGER IF EXISTS translation_fts_au")
-            cursor.execute('''
-                CREATE VIRTUAL TABLE translation_fts 
-                USING fts5(
-                    original_text, 
-                    translated_text, 
-                    content='translation_history', 
-                    content_rowid='id'
+                    created_time DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    namespace TEXT NOT NULL DEFAULT ''
                 )
             ''')
-            cursor.execute('''
-                CREATE TRIGGER translation_fts_ai 
-                AFTER INSERT ON translation_history
-                BEGIN
-                    INSERT INTO translation_fts (rowid, original_text, translated_text)
-                    VALUES (new.id, new.original_text, new.translated_text);
-                END
-            ''')
-            cursor.execute('''
-                CREATE TRIGGER translation_fts_ad 
-                AFTER DELETE ON translation_history
-                BEGIN
-                    DELETE FROM translation_fts WHERE rowid = old.id;
-                END
-            ''')
-            cursor.execute('''
-                CREATE TRIGGER translation_fts_au 
-                AFTER UPDATE ON translation_history
-                BEGIN
-                    UPDATE translation_fts 
-                    SET original_text = new.original_text, translated_text = new.translated_text
-                    WHERE rowid = new.id;
-                END
-            ''')
+            if "namespace" not in [row[1] for row in cursor.execute("PRAGMA table_info(translation_history)")]:
+                cursor.execute("ALTER TABLE translation_history ADD COLUMN namespace TEXT NOT NULL DEFAULT ''")
+            cursor.execute("CREATE INDEX IF NOT EXISTS translation_history_namespace ON translation_history (namespace, id)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS translation_history_original ON translation_history (namespace, original_text)")
+
+            # FTS只在新建、升级表结构或换了分词器时重建一次，平时启动不碰它，启动耗时与库的大小无关
+            fts = cursor.execute("SELECT sql FROM sqlite_master WHERE name = 'translation_fts'").fetchone()
+            version = cursor.execute("PRAGMA user_version").fetchone()[0]
+            if fts is None or version < SCHEMA_VERSION or f"tokenize='{self.tokenizer}'" not in fts[0]:
+                self.build_fts(cursor)
+                cursor.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
             
             logging.info("Database创建完成")
             self.conn.commit()
@@ -82,6 +88,63 @@ class DB:
             logging.error(f"Database初始化失败: {e}")
             raise
     
+    def build_fts(self, cursor: sqlite3.Cursor) -> None:
+        """重建FTS表和同步触发器，并从translation_history重新灌入索引
+        \n外部内容表的删改必须用'delete'命令带上旧值，直接DELETE/UPDATE FTS表会弄坏索引"""
+        cursor.execute("DROP TABLE IF EXISTS translation_fts")
+        cursor.execute("DROP TRIGGER IF EXISTS translation_fts_ai")
+        cursor.execute("DROP TRIGGER IF EXISTS translation_fts_ad")
+        cursor.execute("DROP TRIGGER IF EXISTS translation_fts_au")
+        cursor.execute(f'''
+            CREATE VIRTUAL TABLE translation_fts 
+            USING fts5(
+                original_text, 
+                translated_text, 
+                content='translation_history', 
+                content_rowid='id',
+                tokenize='{self.tokenizer}'
+            )
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER translation_fts_ai 
+            AFTER INSERT ON translation_history
+            BEGIN
+                INSERT INTO translation_fts (rowid, original_text, translated_text)
+                VALUES (new.id, new.original_text, new.translated_text);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER translation_fts_ad 
+            AFTER DELETE ON translation_history
+            BEGIN
+                INSERT INTO translation_fts (translation_fts, rowid, original_text, translated_text)
+                VALUES ('delete', old.id, old.original_text, old.translated_text);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER translation_fts_au 
+            AFTER UPDATE ON translation_history
+            BEGIN
+                INSERT INTO translation_fts (translation_fts, rowid, original_text, translated_text)
+                VALUES ('delete', old.id, old.original_text, old.translated_text);
+                INSERT INTO translation_fts (rowid, original_text, translated_text)
+                VALUES (new.id, new.original_text, new.translated_text);
+            END
+        ''')
+        cursor.execute("INSERT INTO translation_fts (translation_fts) VALUES ('rebuild')")
+        logging.info(f"FTS索引已重建，分词器：{self.tokenizer}")
+
+    def reader(self) -> sqlite3.Connection:
+        """当前线程的读连接，第一次用时打开。WAL模式下读连接看到的是已提交的快照，不需要加锁"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            for name in ["cache_size", "mmap_size", "temp_store"]: conn.execute(f"PRAGMA {name}={PRAGMAS[name]}")
+            conn.execute("PRAGMA query_only=ON")
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
     def search(self, keywords: list[str], k: int) -> list[dict]:
         """检索出k个最匹配的结果，输入为关键词列表，输出格式跟save函数的输入格式差不多"""
         if not keywords:
@@ -96,18 +159,19 @@ class DB:
 
             query = '''
                 SELECT 
-                    original_text as OriginalText,
-                    translated_text as TranslatedText
+                    h.original_text as OriginalText,
+                    h.translated_text as TranslatedText
                 FROM translation_fts 
-                WHERE translation_fts MATCH ?
-                ORDER BY rank
+                JOIN translation_history h ON h.id = translation_fts.rowid
+                WHERE translation_fts MATCH ? AND h.namespace = ?
+                ORDER BY bm25(translation_fts, ?, ?)
                 LIMIT ?
             '''
 
-            with self._conn_lock:
-                self.conn.row_factory = sqlite3.Row
-                cursor = self.conn.cursor()
-                cursor.execute(query, (fts_query, k))
+            results = []
+            if fts_query: # trigram下关键词都不足三个字时没有可用的FTS查询，直接走下面的备用搜索
+                cursor = self.reader().cursor()
+                cursor.execute(query, (fts_query, self.namespace, *self.weights, k))
                 results = cursor.fetchall()
                 cursor.close()
 
@@ -120,9 +184,11 @@ class DB:
             
             logging.info(f"全文检索找到 {len(formatted_results)} 条匹配记录")
 
-            if len(formatted_results) < k:
+            # trigram下不少于三个字的词FTS已经查全了，再LIKE一遍只是白白扫全表，所以只把短词交给备用搜索
+            backup_keywords = self.short_terms(keywords) if self.tokenizer == "trigram" else keywords
+            if len(formatted_results) < k and backup_keywords:
                 logging.info(f"FTS结果不足 {k} 条，使用备用搜索补充")
-                backup_results = self.like_search(keywords, k - len(formatted_results))
+                backup_results = self.like_search(backup_keywords, k - len(formatted_results))
 
                 existing_texts = {result["OriginalText"] for result in formatted_results}
                 for result in backup_results:
@@ -146,6 +212,10 @@ class DB:
             if cleaned: cleaned_keywords.append(cleaned)
         
         if not cleaned_keywords: return ""
+        if self.tokenizer == "trigram":
+            # 每个词作为短语做子串匹配，不需要前缀*；短于三个字的trigram查不了，交给备用搜索
+            terms = [term for keyword in cleaned_keywords for term in keyword.split() if len(term) >= 3]
+            return ' OR '.join(f'"{term}"' for term in terms)
         query_parts = []
         for keyword in cleaned_keywords:
             if len(keyword) > 2: query_parts.append(f'{keyword}*')
@@ -153,6 +223,11 @@ class DB:
         
         return ' OR '.join(query_parts)
     
+    @staticmethod
+    def short_terms(keywords: list[str]) -> list[str]:
+        """trigram索引用不上的短词（不足三个字），切分方式与build_query一致"""
+        return [term for keyword in keywords for term in re.sub(r'["^*]', '', keyword).split() if len(term) < 3]
+
     def like_search(self, keywords: list[str], limit: int) -> list[dict]:
         """备用搜索：直接用LIKE搜索"""
         try:
@@ -173,18 +248,16 @@ class DB:
                     original_text as OriginalText,
                     translated_text as TranslatedText
                 FROM translation_history 
-                WHERE {where_clause}
+                WHERE namespace = ? AND ({where_clause})
                 ORDER BY created_time DESC
                 LIMIT ?
             '''
-            params.append(limit)
+            params = [self.namespace] + params + [limit]
 
-            with self._conn_lock:
-                self.conn.row_factory = sqlite3.Row
-                cursor = self.conn.cursor()
-                cursor.execute(query, params)
-                results = cursor.fetchall()
-                cursor.close()
+            cursor = self.reader().cursor()
+            cursor.execute(query, params)
+            results = cursor.fetchall()
+            cursor.close()
             
             formatted_results = []
             for row in results:
@@ -201,71 +274,71 @@ class DB:
             return []
     
     def save(self, translations: list[dict]) -> bool:
-        """存入，格式为：[{ "OriginalText": , "TranslatedText": }]"""
+        """存入，格式为：[{ "OriginalText": , "TranslatedText": }]
+        \n带id的按id更新（不存在则以该id插入），不带id的新增。整批用executemany在一个事务里写完
+        \n id只在当前namespace里有意义：该id已被别的namespace占用时改为新增一条，绝不覆盖别的namespace的记录"""
         if not translations:
             logging.warning("传入的翻译记录列表为空")
             return True
+        upserts = []
+        inserts = []
+        for translation in translations:
+            if not isinstance(translation.get("OriginalText"), str) or not isinstance(translation.get("TranslatedText"), str):
+                logging.error(f"保存单条记录失败: {translation}, 错误: 缺少OriginalText或TranslatedText")
+                continue
+            if translation.get("id") is not None: upserts.append((translation["id"], translation["OriginalText"], translation["TranslatedText"], self.namespace))
+            else: inserts.append((translation["OriginalText"], translation["TranslatedText"], self.namespace))
         try:
-            success_count = 0
             with self._conn_lock:
-                cursor = self.conn.cursor()
-                for translation in translations:
-                    try:
-                        if "id" in translation and translation["id"] is not None:
-                            cursor.execute("SELECT id FROM translation_history WHERE id = ?", (translation["id"],))
-                            if cursor.fetchone():
-                                cursor.execute('''
-                                    UPDATE translation_history 
-                                    SET original_text = ?, translated_text = ?
-                                    WHERE id = ?
-                                ''', (
-                                    translation["OriginalText"],
-                                    translation["TranslatedText"],
-                                    translation["id"]
-                                ))
-                                logging.info(f"更新记录 ID: {translation['id']}")
-                            else:
-                                logging.warning(f"记录 ID {translation['id']} 不存在，执行插入操作")
-                                cursor.execute('''
-                                    INSERT INTO translation_history (original_text, translated_text)
-                                    VALUES (?, ?)
-                                ''', (
-                                    translation["OriginalText"],
-                                    translation["TranslatedText"]
-                                ))
-                        else:
-                            cursor.execute('''
-                                INSERT INTO translation_history (original_text, translated_text)
-                                VALUES (?, ?)
-                            ''', (
-                                translation["OriginalText"],
-                                translation["TranslatedText"]
-                            ))
-                            logging.debug("插入新记录")
-                        success_count += 1
-                    except Exception as e:
-                        logging.error(f"保存单条记录失败: {translation}, 错误: {e}")
-                        continue
-                self.conn.commit()
-                cursor.close()
+                with self.conn: # 一个事务，出错整批回滚
+                    foreign = self.foreign_ids([upsert[0] for upsert in upserts])
+                    if foreign:
+                        inserts += [upsert[1:] for upsert in upserts if upsert[0] in foreign]
+                        upserts = [upsert for upsert in upserts if upsert[0] not in foreign]
+                    if upserts:
+                        self.conn.executemany('''
+                            INSERT INTO translation_history (id, original_text, translated_text, namespace)
+                            VALUES (?, ?, ?, ?)
+                            ON CONFLICT(id) DO UPDATE SET
+                                original_text = excluded.original_text,
+                                translated_text = excluded.translated_text
+                            WHERE translation_history.namespace = excluded.namespace
+                        ''', upserts)
+                    if inserts:
+                        self.conn.executemany('''
+                            INSERT INTO translation_history (original_text, translated_text, namespace)
+                            VALUES (?, ?, ?)
+                        ''', inserts)
+            success_count = len(upserts) + len(inserts)
             logging.info(f"成功保存 {success_count}/{len(translations)} 条翻译记录")
             return success_count == len(translations)
         except Exception as e:
             logging.error(f"保存翻译记录过程中发生错误: {e}")
             return False
     
+    def foreign_ids(self, ids: list[int]) -> set[int]:
+        """ids中已被其他namespace占用的，须在持有_conn_lock时调用"""
+        foreign = set()
+        for i in range(0, len(ids), 500):
+            batch = ids[i:i + 500]
+            cursor = self.conn.execute(
+                f"SELECT id FROM translation_history WHERE id IN ({', '.join('?' * len(batch))}) AND namespace != ?",
+                batch + [self.namespace]
+            )
+            foreign.update(row[0] for row in cursor.fetchall())
+        return foreign
+
     def get_all_records(self) -> list[dict]:
         try:
-            with self._conn_lock:
-                self.conn.row_factory = sqlite3.Row
-                cursor = self.conn.cursor()
-                cursor.execute('''
-                    SELECT id, original_text, translated_text, created_time 
-                    FROM translation_history 
-                    ORDER BY id
-                ''')
-                rows = cursor.fetchall()
-                cursor.close()
+            cursor = self.reader().cursor()
+            cursor.execute('''
+                SELECT id, original_text, translated_text, created_time 
+                FROM translation_history 
+                WHERE namespace = ?
+                ORDER BY id
+            ''', (self.namespace,))
+            rows = cursor.fetchall()
+            cursor.close()
             results = []
             for row in rows:
                 results.append({
@@ -279,13 +352,32 @@ class DB:
             logging.error(f"获取所有记录失败: {e}")
             return []
 
+    def exact_matches(self, texts: list[str]) -> dict[str, str]:
+        """原文完全相同的记忆，返回{原文: 译文}，同一原文有多条时取最新的。走(namespace, original_text)索引，不经过FTS
+        \n译文和原文相同的行（翻译失败留下的原文）不算命中"""
+        texts = list(dict.fromkeys(text for text in texts if text))
+        result = {}
+        try:
+            cursor = self.reader().cursor()
+            for i in range(0, len(texts), 500):
+                batch = texts[i:i + 500]
+                cursor.execute(f'''
+                    SELECT original_text, translated_text
+                    FROM translation_history
+                    WHERE namespace = ? AND original_text IN ({", ".join("?" * len(batch))}) AND translated_text != original_text
+                    ORDER BY id
+                ''', [self.namespace] + batch)
+                for row in cursor.fetchall(): result[row["original_text"]] = row["translated_text"]
+            cursor.close()
+        except Exception as e: logging.error(f"精确匹配查询失败: {e}")
+        return result
+
     def get_total_count(self) -> int:
         try:
-            with self._conn_lock:
-                cursor = self.conn.cursor()
-                cursor.execute("SELECT COUNT(*) FROM translation_history")
-                count = cursor.fetchone()[0]
-                cursor.close()
+            cursor = self.reader().cursor()
+            cursor.execute("SELECT COUNT(*) FROM translation_history WHERE namespace = ?", (self.namespace,))
+            count = cursor.fetchone()[0]
+            cursor.close()
             logging.info(f"数据库中共有 {count} 条翻译记录")
             return count
         except Exception as e:
@@ -303,13 +395,21 @@ class DB:
         except Exception as e:
             logging.error(f"重置自增ID失败: {e}")
 
+    def namespaces(self) -> dict[str, int]:
+        """库里所有namespace及其记录数"""
+        cursor = self.reader().cursor()
+        cursor.execute("SELECT namespace, COUNT(*) FROM translation_history GROUP BY namespace ORDER BY namespace")
+        result = {row[0]: row[1] for row in cursor.fetchall()}
+        cursor.close()
+        return result
+
     def clear(self):
-        """清空"""
+        """清空当前namespace"""
         try:
             with self._conn_lock:
                 cursor = self.conn.cursor()
-                cursor.execute("DELETE FROM translation_history")
-                logging.warning("已清空所有翻译记录")
+                cursor.execute("DELETE FROM translation_history WHERE namespace = ?", (self.namespace,))
+                logging.warning(f"已清空namespace \"{self.namespace}\" 的所有翻译记录")
                 self.conn.commit()
                 cursor.close()
         except Exception as e: logging.error(f"清空数据失败: {e}")
@@ -0,0 +1,54 @@
+import logging
+import os
+import queue
+import sys
+import threading
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib_helper import func_name
+
+class MemoryWriter:
+    def __init__(self, vdb, db, max_pending: int=64, batch_size: int=512):
+        """后台写记忆：Task把翻译结果put进来就返回，不等嵌入和提交
+        \n后台线程把排队的多个块攒成一批（最多batch_size条），一次嵌入、一次事务写入。队列满max_pending个块时put会阻塞，防止积压
+        \n读记忆之前（PostTask开始前、清空前、退出前）要先flush，保证写入都已落地"""
+        self.vdb = vdb
+        self.db = db
+        self.batch_size = batch_size
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, mem_data: list[dict]) -> None:
+        if mem_data: self._queue.put(mem_data)
+
+    def flush(self) -> None:
+        """阻塞到此前put的记忆全部写完"""
+        self._queue.join()
+
+    def close(self) -> None:
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            items = [self._queue.get()]
+            if items[0] is None:
+                self._queue.task_done()
+                return
+            batch = list(items[0])
+            # 把已经在排队的都捎上，凑成一批
+            while len(batch) < self.batch_size:
+                try: item = self._queue.get_nowait()
+                except queue.Empty: break
+                items.append(item)
+                if item is None: break
+                batch += item
+            try:
+                self.vdb.save(batch)
+                self.db.save(batch)
+                logging.debug(f"{func_name()}: 合并写入 {len(items)} 个块共 {len(batch)} 条记忆")
+            except Exception as e: logging.warning(f"{func_name()}: 写入记忆失败：{e}")
+            finally:
+                for _ in items: self._queue.task_done()
+            if items[-1] is None: return
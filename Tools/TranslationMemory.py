@@ -0,0 +1,91 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import xml.etree.ElementTree as ET
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib_helper import load_json_with_comments
+
+# 持久翻译记忆（TM）的导入导出。TM由全文库（tm.db，按namespace分区）和各namespace的向量记忆目录组成
+# 用法：
+#   python Tools/TranslationMemory.py list
+#   python Tools/TranslationMemory.py export 输出.jsonl|输出.tmx [--namespace 名字]
+#   python Tools/TranslationMemory.py import 输入.jsonl|输入.tmx [--namespace 名字]
+
+XML_LANG = "{http://www.w3.org/XML/1998/namespace}lang"
+
+def tm_paths(settings: dict, namespace: str|None=None) -> tuple[str, str, str]:
+    """按settings.json的translation_memory返回(全文库路径, 向量记忆目录, namespace)"""
+    tm = settings.get("translation_memory", {})
+    namespace = tm.get("namespace", "default") if namespace is None else namespace
+    tm_dir = os.path.normpath(tm.get("dir", "./Tools/TM"))
+    return os.path.join(tm_dir, "tm.db"), os.path.join(tm_dir, "vectors", namespace), namespace
+
+def read_records(path: str) -> list[dict]:
+    """读.jsonl（每行{ "OriginalText": , "TranslatedText": }）或.tmx（每个tu取前两个tuv为原文、译文）"""
+    records = []
+    if path.lower().endswith(".tmx"):
+        for tu in ET.parse(path).getroot().iter("tu"):
+            segs = ["".join(tuv.find("seg").itertext()) for tuv in tu.findall("tuv") if tuv.find("seg") is not None]
+            if len(segs) >= 2: records.append({"OriginalText": segs[0], "TranslatedText": segs[1]})
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip(): continue
+                record = json.loads(line)
+                records.append({"OriginalText": record["OriginalText"], "TranslatedText": record["TranslatedText"]})
+    return records
+
+def write_records(records: list[dict], path: str, source_lang: str="und", target_lang: str="und") -> None:
+    if path.lower().endswith(".tmx"):
+        root = ET.Element("tmx", version="1.4")
+        ET.SubElement(root, "header", {
+            "creationtool": "Roaster", "creationtoolversion": "1", "datatype": "plaintext", "segtype": "sentence",
+            "adminlang": "en", "srclang": source_lang, "o-tmf": "Roaster"
+        })
+        body = ET.SubElement(root, "body")
+        for record in records:
+            tu = ET.SubElement(body, "tu")
+            for lang, text in [(source_lang, record["OriginalText"]), (target_lang, record["TranslatedText"])]:
+                ET.SubElement(ET.SubElement(tu, "tuv", {XML_LANG: lang}), "seg").text = text
+        ET.ElementTree(root).write(path, encoding="utf-8", xml_declaration=True)
+    else:
+        with open(path, "w", encoding="utf-8") as f:
+            for record in records: f.write(json.dumps({"OriginalText": record["OriginalText"], "TranslatedText": record["TranslatedText"]}, ensure_ascii=False)+"\n")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="持久翻译记忆的导入导出")
+    parser.add_argument("action", choices=["list", "export", "import"])
+    parser.add_argument("path", nargs="?")
+    parser.add_argument("--namespace", default=None)
+    parser.add_argument("--source-lang", default="und")
+    parser.add_argument("--target-lang", default="und")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    from Tools.Database import DB
+    settings = load_json_with_comments("settings.json")
+    db_path, vector_dir, namespace = tm_paths(settings, args.namespace)
+    fulltext = settings.get("fulltext", {})
+    db = DB(db_path, clean=False, tokenizer=fulltext.get("tokenizer", "trigram"), namespace=namespace)
+
+    if args.action == "list":
+        for name, count in db.namespaces().items(): print(f"{name or '(空)'}\t{count}")
+    elif args.action == "export":
+        records = db.get_all_records()
+        write_records(records, args.path, args.source_lang, args.target_lang)
+        print(f"已从namespace \"{namespace}\" 导出 {len(records)} 条到 {args.path}")
+    else:
+        # 导入要同时进全文库和向量记忆，向量记忆需要嵌入模型
+        from Tools.VectorDatabase import Embedder, VDB
+        records = read_records(args.path)
+        embedder = Embedder(settings["embedding_model_name"], settings.get("embedding_batch_size", 64), settings.get("embedding_cache_size", 20000))
+        vdb = VDB(embedder, index_settings=settings.get("vector_index", {}), persist_dir=vector_dir)
+        for i in range(0, len(records), 1000):
+            db.save(records[i:i + 1000])
+            vdb.save(records[i:i + 1000])
+        vdb.persist()
+        print(f"已向namespace \"{namespace}\" 导入 {len(records)} 条")
+
+if __name__ == "__main__": main()
@@ -0,0 +1,104 @@
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import faiss
+import numpy as np
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib_helper import load_json_with_comments
+from Tools.TranslationMemory import tm_paths
+from Tools.VectorDatabase import Embedder, TextStore, VDB
+
+# 用项目自己的数据比较各种向量索引的召回率、内存和延迟，以不量化的flat为基准
+# 用法：python Tools/VDBBenchmark.py [数据路径...] [-k 10] [--queries 500]
+# 数据路径可以是持久TM的向量记忆目录（translation_memory.dir/vectors/namespace）、转录/翻译出的json文件，或含这些json的目录，不给就用settings.json里的持久记忆目录
+
+CONFIGS = [
+    {"type": "flat", "quantization": "sq8"},
+    {"type": "flat", "quantization": "pq", "rerank": False},
+    {"type": "flat", "quantization": "pq"},
+    {"type": "hnsw", "quantization": "none"},
+    {"type": "hnsw", "quantization": "sq8"},
+    {"type": "ivf", "quantization": "none"},
+    {"type": "ivf", "quantization": "pq"},
+]
+
+def load_texts(paths: list[str]) -> list[str]:
+    """从持久记忆目录或json字幕里收集原文句子，去重"""
+    texts = []
+    for path in paths:
+        path = os.path.normpath(path)
+        if os.path.isdir(path) and os.path.exists(os.path.join(path, "original.blob.npy")):
+            store = TextStore.load(os.path.join(path, "original"))
+            texts += store.get(np.arange(len(store)))
+        elif os.path.isdir(path):
+            texts += load_texts([os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith(".json")])
+        elif path.endswith(".json"):
+            with open(path, "r", encoding="utf-8") as f: data = json.load(f)
+            texts += [segment.get("text", "") for segment in data.get("segments", [])]
+    return list(dict.fromkeys(text.strip() for text in texts if text.strip()))
+
+def build(embedder: Embedder, settings: dict, texts: list[str], work_dir: str) -> tuple[VDB, float]:
+    """建一个VDB并存入texts（嵌入走Embedder的缓存，不会重复算），返回VDB和建索引用时"""
+    vdb = VDB(embedder, index_settings={**settings, "rerank_dir": work_dir})
+    start = time.perf_counter()
+    for i in range(0, len(texts), 1000): vdb.save([{"OriginalText": text, "TranslatedText": ""} for text in texts[i:i + 1000]])
+    return vdb, time.perf_counter() - start
+
+def index_bytes(vdb: VDB) -> int:
+    return len(faiss.serialize_index(vdb.original_index))
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="向量记忆索引基准测试")
+    parser.add_argument("paths", nargs="*")
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    settings = load_json_with_comments("settings.json")
+    paths = args.paths or [tm_paths(settings)[1]]
+    texts = load_texts(paths)
+    if len(texts) < args.queries * 2:
+        print(f"只有{len(texts)}条文本，太少了")
+        return
+    random.Random(args.seed).shuffle(texts)
+    queries, corpus = texts[:args.queries], texts[args.queries:]
+    print(f"库 {len(corpus)} 条，查询 {len(queries)} 条，k={args.k}")
+
+    embedder = Embedder(settings["embedding_model_name"], settings.get("embedding_batch_size", 64), len(texts) + 1)
+    start = time.perf_counter()
+    embedder.embed(texts)
+    print(f"嵌入用时 {time.perf_counter() - start:.1f} 秒")
+    query_embeddings = embedder.embed(queries)
+
+    base = {key: value for key, value in settings.get("vector_index", {}).items() if key not in ["type", "quantization", "rerank"]}
+    # 库比默认训练量小时按库的大小训练，否则量化索引一直是flat，测不出东西
+    base["train_size"] = min(base.get("train_size", 0) or len(corpus), len(corpus))
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        flat, _ = build(embedder, {**base, "type": "flat", "quantization": "none"}, corpus, work_dir)
+        start = time.perf_counter()
+        exact = flat.search_ids("OriginalText", query_embeddings, args.k)
+        flat_latency = (time.perf_counter() - start) / len(queries) * 1000
+        flat_bytes = index_bytes(flat)
+        print(f"{'索引':<24}{'recall@k':>10}{'字节/条':>10}{'压缩比':>8}{'ms/查询':>10}{'建索引秒':>10}")
+        print(f"{'Flat':<24}{1.0:>10.3f}{flat_bytes / len(corpus):>10.0f}{1.0:>8.1f}{flat_latency:>10.3f}{0.0:>10.1f}")
+
+        for config in CONFIGS:
+            vdb, build_time = build(embedder, {**base, **config}, corpus, work_dir)
+            start = time.perf_counter()
+            approx = vdb.search_ids("OriginalText", query_embeddings, args.k)
+            latency = (time.perf_counter() - start) / len(queries) * 1000
+            recall = np.mean([len({i for _, i in a} & {i for _, i in e}) / max(1, len(e)) for a, e in zip(approx, exact)])
+            name = vdb.factory_string() + (" +rerank" if vdb.rerank else "")
+            if not vdb.get_stats()["trained"]: name += " (未训练)"
+            size = index_bytes(vdb)
+            print(f"{name:<24}{recall:>10.3f}{size / len(corpus):>10.0f}{flat_bytes / size:>8.1f}{latency:>10.3f}{build_time:>10.1f}")
+
+if __name__ == "__main__": main()
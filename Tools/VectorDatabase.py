@@ -1,15 +1,28 @@
+import array
+import collections
+import gc
+import hashlib
+import json
 import logging
 import os
 import faiss
-import sqlite3
 import numpy as np
 import torch
 import threading
 from transformers import AutoTokenizer, AutoModel
 
 class Embedder: 
-    def __init__(self, model_name="sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"):
-        """提前加载模型，先检查显存"""
+    def __init__(self, model_name="sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2", batch_size=64, cache_size=20000):
+        """提前加载模型，先检查显存
+        \n多个线程同时embed时，谁先拿到模型谁就把所有人排队的文本一起算掉（微批处理）
+        \n算过的向量按文本哈希存在容量为cache_size的LRU里，片头、口头禅之类的重复台词只算一次"""
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._model_lock = threading.Lock()
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         logging.info(f"使用设备: {self.device}")
         try:
@@ -24,14 +37,56 @@ class Embedder:
     def embed(self, texts: list[str]) -> np.array:
         """将文本列表转换为嵌入向量"""
         if isinstance(texts, str): texts = [texts]
-        
+        keys = [hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest() for text in texts]
+
+        vectors = {}
+        with self._cache_lock:
+            for key in keys:
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    vectors[key] = self._cache[key]
+        missing = {key: text for key, text in zip(keys, texts) if key not in vectors}
+        if missing: vectors.update(self._compute(missing))
+        return np.stack([vectors[key] for key in keys]).astype(np.float32)
+
+    def _compute(self, texts: dict[bytes, str]) -> dict[bytes, np.ndarray]:
+        """把texts排进队列，拿到模型的线程把队列里所有请求合在一起算，算完各自取走自己的结果"""
+        request = {"texts": texts, "done": threading.Event(), "vectors": None, "error": None}
+        with self._pending_lock: self._pending.append(request)
+        with self._model_lock:
+            if not request["done"].is_set():
+                with self._pending_lock: batch, self._pending = self._pending, []
+                merged = {}
+                for r in batch: merged.update(r["texts"])
+                try: result = self._run(merged)
+                except Exception as e: result, error = None, e
+                else: error = None
+                for r in batch:
+                    r["vectors"] = {key: result[key] for key in r["texts"]} if result is not None else None
+                    r["error"] = error
+                    r["done"].set()
+        if request["error"] is not None: raise request["error"]
+        return request["vectors"]
+
+    def _run(self, texts: dict[bytes, str]) -> dict[bytes, np.ndarray]:
+        """按长度排序后分批跑模型，同一批长度相近，padding最少。调用方需持有_model_lock"""
+        items = sorted(texts.items(), key=lambda item: len(item[1]))
+        result = {}
         with torch.no_grad():
-            inputs = self.tokenizer(texts, padding=True, truncation=True, 
-                                  max_length=512, return_tensors="pt").to(self.device)
-            outputs = self.model(**inputs)
-            embeddings = self.mean_pooling(outputs, inputs['attention_mask'])
-            embeddings = torch.nn.functional.normalize(embeddings, p=2, dim=1)
-            return embeddings.cpu().numpy()
+            for i in range(0, len(items), self.batch_size):
+                batch = items[i:i + self.batch_size]
+                inputs = self.tokenizer([text for _, text in batch], padding=True, truncation=True, 
+                                      max_length=512, return_tensors="pt").to(self.device)
+                outputs = self.model(**inputs)
+                embeddings = self.mean_pooling(outputs, inputs['attention_mask'])
+                embeddings = torch.nn.functional.normalize(embeddings, p=2, dim=1).cpu().numpy()
+                for (key, _), embedding in zip(batch, embeddings): result[key] = embedding
+        with self._cache_lock:
+            for key, embedding in result.items():
+                self._cache[key] = embedding
+                self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size: self._cache.popitem(last=False)
+        return result
 
     def mean_pooling(self, model_output, attention_mask):
         token_embeddings = model_output.last_hidden_state
@@ -39,55 +94,256 @@ class Embedder:
         return torch.sum(token_embeddings * input_mask_expanded, 1) / torch.clamp(input_mask_expanded.sum(1), min=1e-9)
 
 
+class TextStore:
+    def __init__(self, base_blob: np.ndarray|None=None, base_offsets: np.ndarray|None=None):
+        """只追加的文本存储：文本UTF-8编码后首尾相接放在一个blob里，第i条是blob[offsets[i]:offsets[i+1]]，i即db_id
+        \n已持久化的部分（base）内存映射自磁盘，本次会话追加的（extra）在内存里"""
+        self.base_blob = base_blob if base_blob is not None else np.zeros(0, np.uint8)
+        self.base_offsets = base_offsets if base_offsets is not None else np.zeros(1, np.int64)
+        self.extra_blob = bytearray()
+        self.extra_offsets = array.array("q", [0])
+
+    @classmethod
+    def load(cls, prefix: str) -> "TextStore":
+        return cls(np.load(prefix+".blob.npy", mmap_mode="r"), np.load(prefix+".offsets.npy", mmap_mode="r"))
+
+    def append(self, texts: list[str]) -> None:
+        for text in texts:
+            self.extra_blob += text.encode("utf-8")
+            self.extra_offsets.append(len(self.extra_blob))
+
+    def get(self, ids) -> list[str]:
+        """按db_id批量取文本。起止位置用数组下标一次取出，只有最后的解码是逐条的"""
+        ids = np.asarray(ids, np.int64)
+        base_count = len(self.base_offsets) - 1
+        in_base = ids < base_count
+        starts = np.empty(len(ids), np.int64)
+        ends = np.empty(len(ids), np.int64)
+        starts[in_base] = self.base_offsets[ids[in_base]]
+        ends[in_base] = self.base_offsets[ids[in_base] + 1]
+        extra_offsets = np.frombuffer(self.extra_offsets, np.int64)
+        starts[~in_base] = extra_offsets[ids[~in_base] - base_count]
+        ends[~in_base] = extra_offsets[ids[~in_base] - base_count + 1]
+        return [
+            (self.base_blob[start:end].tobytes() if base else bytes(self.extra_blob[start:end])).decode("utf-8")
+            for start, end, base in zip(starts, ends, in_base)
+        ]
+
+    def save(self, prefix: str) -> None:
+        """base和extra合并写到prefix.blob.npy和prefix.offsets.npy"""
+        extra_offsets = np.frombuffer(self.extra_offsets, np.int64)
+        with open(prefix+".blob.npy", "wb") as f: np.save(f, np.concatenate([np.asarray(self.base_blob), np.frombuffer(bytes(self.extra_blob), np.uint8)]))
+        with open(prefix+".offsets.npy", "wb") as f: np.save(f, np.concatenate([np.asarray(self.base_offsets), self.base_offsets[-1] + extra_offsets[1:]]))
+
+    def __len__(self) -> int:
+        return len(self.base_offsets) - 1 + len(self.extra_offsets) - 1
+
+
+class VectorStore:
+    def __init__(self, path: str, dim: int):
+        """只追加的float32向量文件，第i行即db_id为i的向量。量化索引重排时用它算精确相似度
+        \n向量放在磁盘上，读的时候按需内存映射，不占常驻内存"""
+        self.path = path
+        self.dim = dim
+        self._map = None
+        if not os.path.exists(self.path): open(self.path, "wb").close()
+
+    def append(self, vectors: np.ndarray) -> None:
+        with open(self.path, "ab") as f: f.write(np.ascontiguousarray(vectors, np.float32).tobytes())
+        self._map = None
+
+    def get(self, ids) -> np.ndarray:
+        if self._map is None:
+            if not len(self): return np.zeros((0, self.dim), np.float32)
+            self._map = np.memmap(self.path, np.float32, "r").reshape(-1, self.dim)
+        return self._map[np.asarray(ids, np.int64)]
+
+    def truncate(self, count: int) -> None:
+        """只保留前count条。持久模式下上次没来得及persist就退出时，向量文件会比文本多出几行"""
+        self._map = None
+        if len(self) > count:
+            with open(self.path, "r+b") as f: f.truncate(count * self.dim * 4)
+
+    def __len__(self) -> int:
+        return os.path.getsize(self.path) // (self.dim * 4)
+
+
 class VDB:
-    def __init__(self, embedder: Embedder, temp_path="./Tools/VDBTemp.db", clean=True):
+    def __init__(self, embedder: Embedder, clean=True, index_settings: dict|None=None, persist_dir: str|None=None):
         """先检查能不能用显存，能则用，不能则用CPU
-        \n embedder输出单位向量"""
+        \n embedder输出单位向量
+        \n index_settings即settings.json的vector_index：type可选flat（精确）、hnsw、ivf（近似），quantization可选none、sq8、pq。只有不量化的flat用GPU
+        \n persist_dir不为None时是持久记忆模式：文本和索引都放在该目录，启动时不清空，内存映射打开
+        \n索引都包在IndexIDMap2里，search直接返回db_id；文本放在TextStore里，db_id就是行号"""
         self.embedder = embedder.embed  # nparray
         self.dim = self.embedder(["init"]).shape[1] 
-        self.temp_path = os.path.normpath(temp_path)
-        self.next_id = 0
-        self.id_map = {} 
+        self.persist_dir = os.path.normpath(persist_dir) if persist_dir else None
+        if self.persist_dir:
+            os.makedirs(self.persist_dir, exist_ok=True)
+            clean = False
+        self._lock = threading.Lock()
+        self.original_texts = TextStore()
+        self.translated_texts = TextStore()
+        self.index_settings = index_settings or {}
+        self.index_type = self.index_settings.get("type", "flat")
+        self.quantization = self.index_settings.get("quantization", "none")
+        self.needs_training = not faiss.index_factory(self.dim, self.factory_string(), faiss.METRIC_INNER_PRODUCT).is_trained
+        self.trained = False
+        # 持久模式下从磁盘内存映射打开的只读索引，本次会话新增的向量进original_index/translated_index，persist时合并
+        self.base_original = None
+        self.base_translated = None
+
+        # 量化后相似度有误差，rerank时按精确向量重新打分。精确向量存在磁盘上，不占内存
+        self.rerank = self.quantization != "none" and self.index_settings.get("rerank", True)
+        if self.rerank:
+            vector_dir = self.persist_dir or os.path.normpath(self.index_settings.get("rerank_dir", "./Tools/VDBVectors"))
+            os.makedirs(vector_dir, exist_ok=True)
+            self.original_vectors = VectorStore(os.path.join(vector_dir, "original.f32"), self.dim)
+            self.translated_vectors = VectorStore(os.path.join(vector_dir, "translated.f32"), self.dim)
 
         # 两个索引，一个原文，一个译文
-        if torch.cuda.is_available():
+        if torch.cuda.is_available() and self.index_type == "flat" and self.quantization == "none":
             try:
                 self.res = faiss.StandardGpuResources()
-                self.original_index = faiss.GpuIndexFlatIP(self.res, self.dim)
-                self.translated_index = faiss.GpuIndexFlatIP(self.res, self.dim)
+                self.original_index = faiss.IndexIDMap2(faiss.GpuIndexFlatIP(self.res, self.dim))
+                self.translated_index = faiss.IndexIDMap2(faiss.GpuIndexFlatIP(self.res, self.dim))
                 self.use_gpu = True
                 logging.info("使用GPU")
             except Exception as e:
                 logging.info(f"GPU不能用：{e}。使用CPU")
-                self.original_index = faiss.IndexFlatIP(self.dim)
-                self.translated_index = faiss.IndexFlatIP(self.dim)
+                self.original_index = self.new_index()
+                self.translated_index = self.new_index()
                 self.use_gpu = False
         else:
-            self.original_index = faiss.IndexFlatIP(self.dim)
-            self.translated_index = faiss.IndexFlatIP(self.dim)
+            self.original_index = self.new_index()
+            self.translated_index = self.new_index()
             self.use_gpu = False
-            logging.info("使用CPU")
-        self.init_sqlite()
+            logging.info(f"使用CPU，索引：{self.factory_string()}")
+        if self.persist_dir: self.load_persistent()
         if clean: self.clear()
-    
-    def init_sqlite(self):
-        """初始化SQLite数据库"""
-        # allow using the connection from multiple threads; protect access with a lock
-        self.conn = sqlite3.connect(self.temp_path, check_same_thread=False)
-        self.cursor = self.conn.cursor()
-        self._conn_lock = threading.Lock()
-        with self._conn_lock:
-            self.cursor.execute('''
-                CREATE TABLE IF NOT EXISTS texts (
-                    id INTEGER PRIMARY KEY,
-                    original_text TEXT,
-                    translated_text TEXT
-                )
-            ''')
-            self.conn.commit()
-            self.cursor.execute("SELECT MAX(id) FROM texts")
-            result = self.cursor.fetchone()
-            self.next_id = result[0] + 1 if result[0] is not None else 0
+
+    @property
+    def next_id(self) -> int:
+        return len(self.original_texts)
+
+    def pq_m(self) -> int:
+        """PQ的子空间数，须整除dim。默认取不超过dim/4的最大约数，384维即96字节一条，压缩16倍"""
+        m = self.index_settings.get("pq_m", 0) or self.dim // 4
+        while self.dim % m: m -= 1
+        return m
+
+    def factory_string(self) -> str:
+        """vector_index对应的faiss.index_factory描述串"""
+        codec = {"sq8": "SQ8", "pq": f"PQ{self.pq_m()}"}.get(self.quantization, "Flat")
+        if self.index_type == "hnsw":
+            m = self.index_settings.get("hnsw_m", 32)
+            return f"HNSW{m}" if codec == "Flat" else f"HNSW{m}_{codec}"
+        if self.index_type == "ivf": return f"IVF{self.index_settings.get('ivf_nlist', 256)},{codec}"
+        return codec
+
+    def train_size(self) -> int:
+        """训练所需的向量数。faiss建议每个聚类中心至少39个训练点：IVF是nlist个中心，PQ每个子空间256个"""
+        if self.index_settings.get("train_size", 0): return self.index_settings["train_size"]
+        size = 1000 # SQ8只需统计每一维的范围
+        if self.index_type == "ivf": size = max(size, self.index_settings.get("ivf_nlist", 256) * 39)
+        if self.quantization == "pq": size = max(size, 256 * 39)
+        return size
+
+    def tune(self, index):
+        """设置搜索时的召回/速度参数（efSearch、nprobe）"""
+        inner = faiss.downcast_index(index.index)
+        if hasattr(inner, "hnsw"): inner.hnsw.efSearch = self.index_settings.get("ef_search", 64)
+        if isinstance(inner, faiss.IndexIVF): inner.nprobe = self.index_settings.get("ivf_nprobe", 16)
+        return index
+
+    def new_index(self):
+        """建一个空的CPU索引。都用内积度量，向量是单位向量，返回的相似度仍是余弦，threshold的含义不变
+        \n ivf和量化索引要先训练，向量不够时先用flat顶着，够了由to_trained迁移"""
+        if self.needs_training: return faiss.IndexIDMap2(faiss.IndexFlatIP(self.dim))
+        index = faiss.index_factory(self.dim, self.factory_string(), faiss.METRIC_INNER_PRODUCT)
+        if hasattr(index, "hnsw"): index.hnsw.efConstruction = self.index_settings.get("ef_construction", 80)
+        return self.tune(faiss.IndexIDMap2(index))
+
+    def to_trained(self, index):
+        """index还是顶替用的flat且向量够训练时，用这些向量训练目标索引并连同db_id搬进去，否则原样返回"""
+        if not self.needs_training or not isinstance(faiss.downcast_index(index.index), faiss.IndexFlat): return index
+        if index.ntotal < self.train_size(): return index
+
+        vectors = faiss.downcast_index(index.index).reconstruct_n(0, index.ntotal)
+        trained = faiss.index_factory(self.dim, self.factory_string(), faiss.METRIC_INNER_PRODUCT)
+        if hasattr(trained, "hnsw"): trained.hnsw.efConstruction = self.index_settings.get("ef_construction", 80)
+        trained.train(vectors)
+        trained = self.tune(faiss.IndexIDMap2(trained))
+        trained.add_with_ids(vectors, faiss.vector_to_array(index.id_map))
+        logging.info(f"{self.factory_string()}索引训练完毕，{trained.ntotal}条向量")
+        return trained
+
+    def train_index(self) -> None:
+        """攒够向量后把内存里的两个索引换成训练好的目标索引。持久模式由persist统一处理。调用方需持有_lock"""
+        if self.trained or self.persist_dir: return
+        original_index = self.to_trained(self.original_index)
+        if original_index is self.original_index: return
+        self.original_index, self.translated_index = original_index, self.to_trained(self.translated_index)
+        self.trained = True
+
+    def persist_path(self, name: str) -> str:
+        return os.path.join(self.persist_dir, name)
+
+    def load_persistent(self) -> None:
+        """内存映射打开persist_dir里的索引和文本，只读，启动几乎不花时间和内存"""
+        meta_path = self.persist_path("meta.json")
+        if not os.path.exists(meta_path): return
+        with open(meta_path, "r", encoding="utf-8") as f: meta = json.load(f)
+        if meta.get("dim") != self.dim:
+            logging.warning(f"持久记忆的向量维度{meta.get('dim')}与当前嵌入模型{self.dim}不符，不加载")
+            return
+        indexes = []
+        for name in ["original", "translated"]:
+            # IVF的倒排表用IO_FLAG_MMAP映射；flat和hnsw的向量存储用IO_FLAG_MMAP_IFC映射（旧版faiss没有，就整个读进来）
+            flag = faiss.IO_FLAG_MMAP if meta.get(name) == "ivf" else getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+            indexes.append(self.tune(faiss.read_index(self.persist_path(f"{name}.index"), flag)))
+        self.base_original, self.base_translated = indexes
+        self.original_texts = TextStore.load(self.persist_path("original"))
+        self.translated_texts = TextStore.load(self.persist_path("translated"))
+        if self.rerank:
+            self.original_vectors.truncate(len(self.original_texts))
+            self.translated_vectors.truncate(len(self.translated_texts))
+        logging.info(f"已映射持久记忆：{self.base_original.ntotal}条向量")
+
+    def persist(self) -> None:
+        """把磁盘上的索引、文本和本次会话新增的合并写回persist_dir，再重新映射打开。非持久模式什么都不做
+        \n合并时会把磁盘上的索引完整读进内存一次，所以放在退出时调用"""
+        if not self.persist_dir: return
+        with self._lock:
+            if self.original_index.ntotal == 0: return
+            meta = {"dim": self.dim}
+            for name, delta, texts in [("original", self.original_index, self.original_texts), ("translated", self.translated_index, self.translated_texts)]:
+                path = self.persist_path(f"{name}.index")
+                index = faiss.read_index(path) if self.base_original is not None else self.new_index()
+                index.add_with_ids(faiss.downcast_index(delta.index).reconstruct_n(0, delta.ntotal), faiss.vector_to_array(delta.id_map))
+                index = self.to_trained(index)
+                meta[name] = "ivf" if isinstance(faiss.downcast_index(index.index), faiss.IndexIVF) else "flat"
+                faiss.write_index(index, path+".tmp")
+                del index
+                texts.save(self.persist_path(f"{name}.tmp"))
+            with open(self.persist_path("meta.json.tmp"), "w", encoding="utf-8") as f: json.dump(meta, f)
+
+            # 先放掉旧文件的映射再替换（Windows下映射中的文件不能被替换）
+            self.base_original = self.base_translated = None
+            self.original_texts = self.translated_texts = None
+            gc.collect()
+            for name in ["original", "translated"]:
+                os.replace(self.persist_path(f"{name}.index.tmp"), self.persist_path(f"{name}.index"))
+                os.replace(self.persist_path(f"{name}.tmp.blob.npy"), self.persist_path(f"{name}.blob.npy"))
+                os.replace(self.persist_path(f"{name}.tmp.offsets.npy"), self.persist_path(f"{name}.offsets.npy"))
+            os.replace(self.persist_path("meta.json.tmp"), self.persist_path("meta.json"))
+            self.load_persistent()
+            self.original_index = self.new_index()
+            self.translated_index = self.new_index()
+        logging.info(f"持久记忆已写回：{self.base_original.ntotal}条向量")
+
+    def total(self) -> int:
+        return (self.base_original.ntotal if self.base_original is not None else 0) + self.original_index.ntotal
     
     def save(self, messagelist: list[dict[str, str]]):
         """存入，格式为：[{ "OriginalText": , "TranslatedText": }]"""
@@ -96,8 +352,9 @@ class VDB:
         original_texts = [msg.get("OriginalText", "") for msg in messagelist]
         translated_texts = [msg.get("TranslatedText", "") for msg in messagelist]
 
-        original_embeddings = self.embedder(original_texts)
-        translated_embeddings = self.embedder(translated_texts)
+        # 原文译文一起送进去，合成一批算
+        embeddings = self.embedder(original_texts + translated_texts)
+        original_embeddings, translated_embeddings = embeddings[:len(messagelist)], embeddings[len(messagelist):]
 
         for embeddings in [original_embeddings, translated_embeddings]:
             if isinstance(embeddings, torch.Tensor):
@@ -105,91 +362,113 @@ class VDB:
             embeddings = embeddings.astype(np.float32)
             faiss.normalize_L2(embeddings)
         
-        start_index = self.original_index.ntotal  
-        self.original_index.add(original_embeddings)
-        self.translated_index.add(translated_embeddings)
-        
-# Insert DB records under lock; embeddings and FAISS ops are done outside the lock
-        with self._conn_lock:
-            for i, msg in enumerate(messagelist):
-                db_id = self.next_id + i
-                faiss_index = start_index + i
-                self.id_map[faiss_index] = db_id
-
-                self.cursor.execute(
-                    "INSERT INTO texts (id, original_text, translated_text) VALUES (?, ?, ?)",
-                    (db_id, msg.get("OriginalText", ""), msg.get("TranslatedText", ""))
-                )
-            self.next_id += len(messagelist)
-            self.conn.commit()
+        # 嵌入在锁外完成；分配db_id、写索引和写文本必须在同一把锁里，否则并发save时会错位
+        with self._lock:
+            ids = np.arange(self.next_id, self.next_id + len(messagelist), dtype=np.int64)
+            self.original_index.add_with_ids(original_embeddings, ids)
+            self.translated_index.add_with_ids(translated_embeddings, ids)
+            self.original_texts.append(original_texts)
+            self.translated_texts.append(translated_texts)
+            if self.rerank:
+                self.original_vectors.append(original_embeddings)
+                self.translated_vectors.append(translated_embeddings)
+            self.train_index()
         logging.info(f"保存了 {len(messagelist)} 条记录")
     
     def search(self, query: dict, k: int, threshold=0.6) -> list[dict]:
         """用IndexFlatIP取k个最相似且相似度大于threshold的记忆，不够就把有的拿出来
         \n输入为{ "OriginalText": , "TranslatedText": }，提供了哪些就用哪个查找，如果都提供了就用OriginalText
         \n输出格式和save的输入格式一样"""
-        if self.original_index.ntotal == 0: return []
-        
-        search_text = ""
-        use_original = False
-        use_translated = False
-
-        if "OriginalText" in query and query["OriginalText"]: 
-            search_text = query["OriginalText"]
-            use_original = True
-        elif "TranslatedText" in query and query["TranslatedText"]: 
-            search_text = query["TranslatedText"]
-            use_translated = True
-        else: return []
-
-        query_embedding = self.embedder([search_text])
-        if isinstance(query_embedding, torch.Tensor):
-            query_embedding = query_embedding.cpu().numpy()
-        
-        query_embedding = query_embedding.astype(np.float32)
-        faiss.normalize_L2(query_embedding)
-
-        if use_original: search_index = self.original_index
-        else: search_index = self.translated_index
-            
-        actual_k = min(k, search_index.ntotal)
-        similarities, indices = search_index.search(query_embedding, actual_k)
-        
-        results = []
-        for i in range(actual_k):
-            similarity = similarities[0][i]
-
-            if similarity >= threshold:
-                faiss_index = indices[0][i]
-                db_id = self.id_map.get(faiss_index)
-                
-                if db_id is not None:
-                    with self._conn_lock:
-                        self.cursor.execute(
-                            "SELECT original_text, translated_text FROM texts WHERE id = ?", 
-                            (db_id,)
-                        )
-                        result = self.cursor.fetchone()
-                    if result:
-                        results.append({
-                            "OriginalText": result[0],
-                            "TranslatedText": result[1],
-                            "Similarity": float(similarity)
-                        })
+        return self.search_many([query], k, threshold)
+
+    def search_many(self, queries: list[dict], k: int, threshold=0.6) -> list[dict]:
+        """一次查多条，每条的格式和search相同。所有查询一起嵌入，每个索引只调用一次search，命中的文本从TextStore批量切出
+        \n同一条记忆被多条查询命中时只出现一次，取最高的相似度，结果按相似度从高到低排列"""
+        if self.total() == 0: return []
+
+        groups = {"OriginalText": [], "TranslatedText": []}
+        for query in queries:
+            if "OriginalText" in query and query["OriginalText"]: groups["OriginalText"].append(query["OriginalText"])
+            elif "TranslatedText" in query and query["TranslatedText"]: groups["TranslatedText"].append(query["TranslatedText"])
+        if not groups["OriginalText"] and not groups["TranslatedText"]: return []
+
+        best = {} # db_id -> 相似度
+        for field, texts in groups.items():
+            if not texts: continue
+            query_embeddings = self.embedder(texts)
+            if isinstance(query_embeddings, torch.Tensor):
+                query_embeddings = query_embeddings.cpu().numpy()
+            query_embeddings = query_embeddings.astype(np.float32)
+            faiss.normalize_L2(query_embeddings)
+
+            for row_hits in self.search_ids(field, query_embeddings, k):
+                for similarity, db_id in row_hits:
+                    if similarity >= threshold and similarity > best.get(db_id, -1.0): best[db_id] = similarity
+        if not best: return []
+
+        ranked = sorted(best.items(), key=lambda item: item[1], reverse=True)
+        ids = np.array([db_id for db_id, _ in ranked], np.int64)
+        with self._lock:
+            original_texts = self.original_texts.get(ids)
+            translated_texts = self.translated_texts.get(ids)
+
+        results = [{
+            "OriginalText": original_text,
+            "TranslatedText": translated_text,
+            "Similarity": float(similarity)
+        } for (_, similarity), original_text, translated_text in zip(ranked, original_texts, translated_texts)]
         
         logging.info(f"VectorDatabase查到{results}")
         return results
-    
+
+    def nearest(self, texts: list[str], k: int=3, threshold=0.9) -> list[list[dict]]:
+        """按原文逐条查，和search_many不同，每条查询的结果分开返回（第i个列表对应texts[i]），用于复用翻译记忆"""
+        if self.total() == 0 or not texts: return [[] for _ in texts]
+        query_embeddings = self.embedder(texts)
+        if isinstance(query_embeddings, torch.Tensor):
+            query_embeddings = query_embeddings.cpu().numpy()
+        query_embeddings = query_embeddings.astype(np.float32)
+        faiss.normalize_L2(query_embeddings)
+
+        hits = [[(similarity, db_id) for similarity, db_id in row_hits if similarity >= threshold] for row_hits in self.search_ids("OriginalText", query_embeddings, k)]
+        ids = np.array([db_id for row_hits in hits for _, db_id in row_hits], np.int64)
+        with self._lock:
+            original_texts = iter(self.original_texts.get(ids))
+            translated_texts = iter(self.translated_texts.get(ids))
+        return [[{
+            "OriginalText": next(original_texts),
+            "TranslatedText": next(translated_texts),
+            "Similarity": float(similarity)
+        } for similarity, _ in row_hits] for row_hits in hits]
+
+    def search_ids(self, field: str, query_embeddings: np.ndarray, k: int) -> list[list[tuple[float, int]]]:
+        """对每条查询向量返回最相似的k个(相似度, db_id)，从高到低
+        \n磁盘上的基础索引和本次会话的增量索引各查一遍再合并。开了rerank时每个索引多取rerank_factor倍的候选，用精确向量重新打分"""
+        if field == "OriginalText": search_indexes, vectors = [self.base_original, self.original_index], getattr(self, "original_vectors", None)
+        else: search_indexes, vectors = [self.base_translated, self.translated_index], getattr(self, "translated_vectors", None)
+        fetch = k * self.index_settings.get("rerank_factor", 4) if self.rerank else k
+
+        hits = [[] for _ in query_embeddings]
+        with self._lock:
+            for search_index in search_indexes:
+                if search_index is None or not search_index.ntotal: continue
+                similarities, indices = search_index.search(query_embeddings, min(fetch, search_index.ntotal))
+                for row, (row_similarities, row_indices) in enumerate(zip(similarities, indices)):
+                    hits[row] += [(float(similarity), int(db_id)) for similarity, db_id in zip(row_similarities, row_indices) if db_id >= 0]
+            if self.rerank:
+                for row, row_hits in enumerate(hits):
+                    if not row_hits: continue
+                    ids = [db_id for _, db_id in row_hits]
+                    hits[row] = list(zip((vectors.get(ids) @ query_embeddings[row]).tolist(), ids))
+        return [sorted(row_hits, reverse=True)[:k] for row_hits in hits]
+
     def clear(self): # 待测试
-        """把用于对应向量的数据库清空，id归零。包括内存中的向量索引"""
-        # 清SQLite
-        if hasattr(self, '_conn_lock'):
-            with self._conn_lock:
-                if hasattr(self, 'cursor') and self.cursor:
-                    self.cursor.execute("DELETE FROM texts")
-                    self.conn.commit()
-                self.next_id = 0
-                self.id_map.clear() 
+        """把用于对应向量的文本清空，id归零。包括内存中的向量索引"""
+        with self._lock:
+            self.original_texts = TextStore()
+            self.translated_texts = TextStore()
+            self.base_original = self.base_translated = None
+            if self.persist_dir and os.path.exists(self.persist_path("meta.json")): os.remove(self.persist_path("meta.json"))
 
         if hasattr(self, 'original_index'):
             try:
@@ -213,48 +492,45 @@ class VDB:
             except Exception as e:
                 logging.warning(f"释放GPU资源失败: {e}")
 
-        import gc
         gc.collect()
 
         if self.use_gpu:
             try:
                 self.res = faiss.StandardGpuResources()
-                self.original_index = faiss.GpuIndexFlatIP(self.res, self.dim)
-                self.translated_index = faiss.GpuIndexFlatIP(self.res, self.dim)
+                self.original_index = faiss.IndexIDMap2(faiss.GpuIndexFlatIP(self.res, self.dim))
+                self.translated_index = faiss.IndexIDMap2(faiss.GpuIndexFlatIP(self.res, self.dim))
             except Exception as e:
                 logging.warning(f"重新创建GPU索引失败: {e}, 回退到CPU")
-                self.original_index = faiss.IndexFlatIP(self.dim)
-                self.translated_index = faiss.IndexFlatIP(self.dim)
+                self.original_index = self.new_index()
+                self.translated_index = self.new_index()
                 self.use_gpu = False
         else: 
-            self.original_index = faiss.IndexFlatIP(self.dim)
-            self.translated_index = faiss.IndexFlatIP(self.dim)
+            self.original_index = self.new_index()
+            self.translated_index = self.new_index()
+        self.trained = False
+        if self.rerank:
+            self.original_vectors.truncate(0)
+            self.translated_vectors.truncate(0)
         
         logging.info("数据库和向量索引已清空")
     
     def get_stats(self) -> dict:
-        with self._conn_lock:
-            self.cursor.execute("SELECT COUNT(*) FROM texts")
-            count = self.cursor.fetchone()[0]
-        return {
-            "total_records": count,
-            "next_id": self.next_id,
-            "original_index_size": self.original_index.ntotal,
-            "translated_index_size": self.translated_index.ntotal,
-            "using_gpu": self.use_gpu,
-            "id_map_size": len(self.id_map)
-        }
+        with self._lock:
+            return {
+                "total_records": len(self.original_texts),
+                "next_id": self.next_id,
+                "original_index_size": self.total(),
+                "translated_index_size": (self.base_translated.ntotal if self.base_translated is not None else 0) + self.translated_index.ntotal,
+                "using_gpu": self.use_gpu,
+                "index": self.factory_string(),
+                "trained": not self.needs_training or not isinstance(faiss.downcast_index((self.base_original if self.base_original is not None else self.original_index).index), faiss.IndexFlat)
+            }
     
     def __del__(self):
-        """析构函数，安全地清理资源"""
+        """析构函数，放掉内存映射的索引和文本"""
         try:
-            if hasattr(self, '_conn_lock'):
-                with self._conn_lock:
-                    if hasattr(self, 'conn') and self.conn:
-                        self.conn.close()
-            else:
-                if hasattr(self, 'conn') and self.conn:
-                    self.conn.close()
+            self.base_original = self.base_translated = None
+            self.original_texts = self.translated_texts = None
         except Exception as e: pass
 
 if __name__ == "__main__": pass
\ No newline at end of file
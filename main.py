@@ -6,35 +6,37 @@ import os, logging
 
 settings = load_json_with_comments("settings.json")
 
-# 日志系统
-if settings["do_log"]:
-    log_dir = settings["log_dir"]
-    log_dir = os.path.normpath(log_dir)
-    os.makedirs(log_dir, exist_ok=True)
-    now = datetime.datetime.now()
-    now = now.strftime("%Y%m%d%H%M%S")
-    path = os.path.join(log_dir, f"log_{now}.txt")
+# 多进程转录用spawn启动子进程，子进程会重新导入本文件，所以启动界面的部分必须放在这个判断里
+if __name__ == "__main__":
+    # 日志系统
+    if settings["do_log"]:
+        log_dir = settings["log_dir"]
+        log_dir = os.path.normpath(log_dir)
+        os.makedirs(log_dir, exist_ok=True)
+        now = datetime.datetime.now()
+        now = now.strftime("%Y%m%d%H%M%S")
+        path = os.path.join(log_dir, f"log_{now}.txt")
     
-    handler = RotatingFileHandler(
-        filename=path,
-        maxBytes=10 * 1024 * 1024, 
-        backupCount=5,        
-        encoding='utf-8'
-    )
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        handlers=[
-            handler,
-            logging.StreamHandler(sys.stdout)
-        ]
-    )
-else:
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        handlers=[logging.StreamHandler(sys.stdout)]
-    )
+        handler = RotatingFileHandler(
+            filename=path,
+            maxBytes=10 * 1024 * 1024, 
+            backupCount=5,        
+            encoding='utf-8'
+        )
+        logging.basicConfig(
+            level=logging.INFO,
+            format='%(asctime)s - %(levelname)s - %(message)s',
+            handlers=[
+                handler,
+                logging.StreamHandler(sys.stdout)
+            ]
+        )
+    else:
+        logging.basicConfig(
+            level=logging.INFO,
+            format='%(asctime)s - %(levelname)s - %(message)s',
+            handlers=[logging.StreamHandler(sys.stdout)]
+        )
 
-from ui import demo
-demo.launch()
\ No newline at end of file
+    from ui import demo
+    demo.launch()
\ No newline at end of file
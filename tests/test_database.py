@@ -0,0 +1,16 @@
+import os
+import sys
+import pytest
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+Database = pytest.importorskip("Tools.Database")
+
+def test_upsert_does_not_overwrite_other_namespace(tmp_path):
+    path = str(tmp_path / "tm.db")
+    a = Database.DB(path, clean=False, namespace="a")
+    b = Database.DB(path, clean=False, namespace="b")
+    a.save([{"id": 5, "OriginalText": "A", "TranslatedText": "a"}])
+    b.save([{"id": 5, "OriginalText": "B", "TranslatedText": "b"}])
+    a.save([{"id": 5, "OriginalText": "A2", "TranslatedText": "a2"}])
+
+    assert [(r["id"], r["OriginalText"]) for r in a.get_all_records()] == [(5, "A2")]
+    assert [r["OriginalText"] for r in b.get_all_records()] == ["B"]
@@ -0,0 +1,60 @@
+import json
+import os
+import sys
+import pytest
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+Framework = pytest.importorskip("Framework")
+from Tools.Database import DB
+
+class FakeLLM:
+    """translate阶段按fail决定返回None（翻译失败）还是逐句加前缀的译文，其余阶段一律回答不需要"""
+    def __init__(self, fail: bool):
+        self.fail = fail
+        self.translate_calls = 0
+
+    def req(self, messages, settings, use_cache=True, stage=None, **kwargs):
+        if stage != "translate": return {"role": "assistant", "content": '{"has_error": false, "need_search": false, "need_web": false}'}
+        self.translate_calls += 1
+        if self.fail: return None
+        chunk = eval(messages[0]["content"].split("原文字幕:\n")[1].split("\n")[0])
+        return {"role": "assistant", "content": json.dumps({"translated": {str(k): "译" + v for k, v in chunk.items()}}, ensure_ascii=False)}
+
+class FakeVDB:
+    def save(self, messagelist): pass
+    def nearest(self, texts, k=3, threshold=0.9): return [[] for _ in texts]
+
+@pytest.fixture
+def framework(tmp_path):
+    framework = Framework.Framework.__new__(Framework.Framework)
+    framework.settings = {
+        "llms": {"SmallModel": {}, "LargeModelJson": {}},
+        "search_local": False,
+        "Crawler": {"enable_crawler": False},
+        "retry": {"max_parse_attempts": 2},
+        "memory_reuse": {"enable": True}
+    }
+    framework.description = ""
+    framework.memory = None
+    framework.db = DB(str(tmp_path / "tm.db"))
+    framework.vdb = FakeVDB()
+    return framework
+
+def test_failed_translation_is_not_reused(framework):
+    framework.llms = FakeLLM(fail=True)
+    assert framework.Task({300: "failing line here"}) == {300: "failing line here"}
+    assert framework.db.get_total_count() == 0
+
+    framework.llms = FakeLLM(fail=False)
+    assert framework.Task({301: "failing line here"}) == {301: "译failing line here"}
+    assert framework.llms.translate_calls == 1
+
+def test_successful_translation_is_reused(framework):
+    framework.llms = FakeLLM(fail=False)
+    framework.Task({1: "repeated line"})
+    framework.llms = FakeLLM(fail=True)
+    assert framework.Task({2: "repeated line"}) == {2: "译repeated line"}
+    assert framework.llms.translate_calls == 0
+
+def test_source_text_rows_are_not_exact_matches(framework):
+    framework.db.save([{"OriginalText": "same", "TranslatedText": "same"}])
+    assert framework.db.exact_matches(["same"]) == {}
@@ -0,0 +1,19 @@
+import json
+import os
+import sys
+import pytest
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+LLMAPI = pytest.importorskip("LLMAPI")
+
+def plan(**fields) -> str:
+    return json.dumps({"has_error": False, "need_search": False, "need_web": False, **fields}, ensure_ascii=False)
+
+@pytest.mark.parametrize("search_type", ["vector或fulltext", "", None])
+def test_search_type_ignored_without_search(search_type):
+    result = LLMAPI.parse_plan(plan(search_type=search_type))
+    assert result is not None
+    assert result["search_type"] == "vector"
+
+def test_search_type_checked_when_searching():
+    assert LLMAPI.parse_plan(plan(need_search=True, search_type="vector或fulltext")) is None
+    assert LLMAPI.parse_plan(plan(need_search=True, search_type="fulltext"))["search_type"] == "fulltext"
@@ -0,0 +1,28 @@
+import os
+import sys
+import pytest
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+openai = pytest.importorskip("openai")
+httpx = pytest.importorskip("httpx")
+LLMAPI = pytest.importorskip("LLMAPI")
+
+def status_error(status: int, retry_after: str|None=None):
+    headers = {"retry-after": retry_after} if retry_after is not None else {}
+    response = httpx.Response(status, headers=headers, request=httpx.Request("POST", "http://localhost/v1/chat/completions"))
+    if status == 429: return openai.RateLimitError("rate limited", response=response, body=None)
+    return openai.InternalServerError("server error", response=response, body=None)
+
+def test_rate_limit_does_not_open_breaker():
+    policy = LLMAPI.RetryPolicy({"breaker_threshold": 2, "max_attempts": 10, "max_delay": 5})
+    for attempt in range(5): assert policy.on_error("endpoint", attempt, status_error(429, "0")) == 0
+    assert policy.open_for("endpoint") == 0
+
+def test_server_errors_open_breaker():
+    policy = LLMAPI.RetryPolicy({"breaker_threshold": 2, "breaker_cooldown": 60})
+    for attempt in range(2): policy.on_error("endpoint", attempt, status_error(500))
+    assert policy.open_for("endpoint") > 0
+
+def test_retry_after_is_honoured_in_full():
+    policy = LLMAPI.RetryPolicy({"max_delay": 5})
+    assert policy.on_error("endpoint", 0, status_error(429, "3")) == 3
+    assert policy.on_error("endpoint", 0, status_error(429, "10")) is None